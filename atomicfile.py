@@ -0,0 +1,19 @@
+import os
+import secrets
+
+
+def mkstemp(directory):
+    """
+    Create a new empty file in directory to write and then os.replace() into
+    place, returns (fd, path).
+
+    Unlike tempfile.mkstemp(), which creates files 0600, the file gets the
+    mode open() would give it, 0666 less the umask of the process, without
+    reading or changing the umask.
+    """
+    while True:
+        path = os.path.join(directory, 'tmp' + secrets.token_hex(8))
+        try:
+            return os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), path
+        except FileExistsError:
+            continue
@@ -0,0 +1,286 @@
+"""
+Benchmark of the eventivalfetch pipeline with synthetic festival data.
+
+Generates Eventival shaped venues, publications, screenings and film
+documents for every scale, serves them from a local HTTP stand-in and runs
+eventivalfetch.main() against it in a fresh process per run. The results,
+with the seconds per stage, are written as JSON so that runs can be compared.
+
+The DB is the one in FILMS_DB_*, it must have the schema and must be local
+(use --any-host to override). Other EVENTIVAL_* settings are passed on to the
+runs, e.g.
+
+    EVENTIVAL_FETCH_WORKERS=8 python benchmark.py --films 100 1000 20000 --output bench.json
+"""
+import os, sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+import http.server
+from xml.sax.saxutils import escape
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRST_FILM_ID = 1000000
+SUBFESTS = (1839, 1838, 2651, 9, 10) # as in eventivalfetch.subfests
+GENRES = ('Drama', 'Comedy', 'Documentary', 'Thriller', 'Animation', 'Horror', 'Romance')
+KEYWORDS = ('love', 'war', 'family', 'music', 'youth', 'nature', 'city', 'memory', 'crime', 'journey')
+COUNTRIES = ('EE', 'FI', 'LV', 'LT', 'DE', 'FR', 'US', 'JP')
+LANGUAGES = ('et', 'en', 'ru', 'fi', 'de', 'fr', 'ja')
+CREW = ('Op/DoP', 'Mont/Ed', 'Muusika/Music', 'Tootja/Production', 'Levitaja/Distributor')
+RELATIONS = ('Director', 'Actor', 'Producer', 'Guest')
+WORDS = ('the', 'film', 'light', 'river', '"winter"', 'house', 'night', 'voice', 'road', 'Tallinn', 'фильм', 'kino')
+
+
+def text(rnd, words):
+    return ' '.join(rnd.choice(WORDS) for i in range(words))
+
+def html(rnd, paragraphs, words):
+    # escaped HTML, as Eventival sends the publication texts
+    return escape(''.join('<p>{text}<br/>{more} &amp; co</p>'.format(text=text(rnd, words), more=text(rnd, 5))
+                          for i in range(paragraphs)))
+
+
+class Festival:
+    """
+    Synthetic Eventival data of one festival edition with films films.
+
+    Every film belongs to one subfest, overlap of them to a second one too.
+    Film documents are generated on request from the film id.
+    """
+    def __init__(self, films, overlap=0.1, screenings=2, seed=1):
+        self.films = films
+        rnd = random.Random(seed)
+        self.film_ids = list(range(FIRST_FILM_ID, FIRST_FILM_ID + films))
+        self.subfest_films = {subfest: [] for subfest in SUBFESTS}
+        for film_id in self.film_ids:
+            for subfest in rnd.sample(SUBFESTS, 2 if rnd.random() < overlap else 1):
+                self.subfest_films[subfest].append(film_id)
+        self.screenings_per_film = screenings
+        self.documents = {'/venues.xml': self.venues(rnd)}
+        for subfest, film_ids in self.subfest_films.items():
+            self.documents['/films/categories/{subfest}/publications-locked.xml'.format(subfest=subfest)] = self.publications(rnd, film_ids)
+            self.documents['/films/categories/{subfest}/screenings.xml'.format(subfest=subfest)] = self.screenings(rnd, film_ids)
+
+    def get(self, path):
+        """ body of path, None if there is no such document """
+        if path in self.documents:
+            return self.documents[path]
+        if path.startswith('/films/') and path.endswith('.xml'):
+            try:
+                film_id = int(path[len('/films/'):-len('.xml')])
+            except ValueError:
+                return None
+            if FIRST_FILM_ID <= film_id < FIRST_FILM_ID + self.films:
+                return self.film(film_id)
+        return None
+
+    def venues(self, rnd):
+        venues = ''.join("""<venue><id>{id}</id><name>Venue {id}</name><company>Cinema {id}</company><company_id>{company}</company_id>
+            <company_contact><address><city>{city}</city></address></company_contact></venue>""".format(
+            id=venue_id, company=venue_id // 3, city=rnd.choice(('Tallinn', 'Tartu', 'Narva'))) for venue_id in range(1, 41))
+        return '<?xml version="1.0" encoding="UTF-8"?><venues>{venues}</venues>'.format(venues=venues).encode()
+
+    def publications(self, rnd, film_ids):
+        items = ''.join("""<item><id>{id}</id><title_english>{title}</title_english><title_original>{title}</title_original>
+            <eventival_categorization><categories><category id="{festival}">Festival {festival}</category></categories>
+            <sections><section><id>{program}</id><name>Program {program}</name></section></sections></eventival_categorization></item>""".format(
+            id=film_id, title=escape(text(rnd, 3)), festival=rnd.randint(1, 5), program=rnd.randint(1, 30)) for film_id in film_ids)
+        return '<?xml version="1.0" encoding="UTF-8"?><films>{items}</films>'.format(items=items).encode()
+
+    def screenings(self, rnd, film_ids):
+        def persons(count):
+            return ''.join('<person id="{id}"><name>Person {id}</name><relations><relation>{relation}</relation></relations></person>'.format(
+                id=rnd.randint(1, 5000), relation=rnd.choice(RELATIONS)) for i in range(count))
+        screenings = []
+        for film_id in film_ids:
+            for i in range(self.screenings_per_film):
+                screenings.append("""<screening><id>{id}</id><code>S{id}</code><venue_id>{venue}</venue_id><cinema_hall_id>{hall}</cinema_hall_id>
+                    <start>2019-11-{day:02d} {hour:02d}:00:00</start><ticketing_url>http://tickets.example/{id}</ticketing_url>
+                    <duration_screening_only_minutes>{minutes}</duration_screening_only_minutes><type_of_screening>regular</type_of_screening>
+                    <film><id>{film_id}</id><languages><print><language>{language}</language></print></languages>
+                    <subtitle_languages><translations><language>en</language><language>et</language></translations></subtitle_languages></film>
+                    <presentation><duration>10</duration><presenters>{presenters}</presenters><guests>{guests}</guests></presentation>
+                    <qa><duration>20</duration><presenters>{qa}</presenters></qa>
+                    <additional_info><et>{info}</et><en>{info}</en></additional_info></screening>""".format(
+                    id=film_id * 10 + i, venue=rnd.randint(1, 40), hall=rnd.randint(1, 100), day=rnd.randint(1, 30), hour=rnd.randint(10, 23),
+                    minutes=rnd.randint(70, 150), film_id=film_id, language=rnd.choice(LANGUAGES),
+                    presenters=persons(1), guests=persons(rnd.randint(0, 3)), qa=persons(1), info=escape(text(rnd, 6))))
+        return '<?xml version="1.0" encoding="UTF-8"?><screenings>{screenings}</screenings>'.format(screenings=''.join(screenings)).encode()
+
+    def film(self, film_id):
+        rnd = random.Random(film_id)
+        def tags(outer, inner, values):
+            return '<{outer}>{values}</{outer}>'.format(outer=outer, values=''.join(
+                '<{inner}><code>{value}</code></{inner}>'.format(inner=inner, value=value) for value in values))
+        def publication(lang):
+            return """<{lang}><directors>{directors}</directors><producers>{people}</producers><writers>{people}</writers><cast>{people}</cast>
+                <synopsis_long>{synopsis}</synopsis_long><synopsis_short>{short}</synopsis_short>
+                <directors_bio>{bio}</directors_bio><directors_filmography>{bio}</directors_filmography>
+                <shooting_formats>{short}</shooting_formats><crew>{crew}</crew></{lang}>""".format(
+                lang=lang, directors=html(rnd, 1, 2), people=html(rnd, 1, 6), synopsis=html(rnd, 4, 40), short=html(rnd, 1, 8),
+                bio=html(rnd, 2, 30), crew=''.join('<contact><type><name>{type}</name></type><text>{name}</text></contact>'.format(
+                    type=escape(rnd.choice(CREW)), name=escape(text(rnd, 2))) for i in range(rnd.randint(2, 8))))
+        return """<?xml version="1.0" encoding="UTF-8"?><film><id>{id}</id>
+            <titles><title_original label="Original title">{title}</title_original><title_local label="Local title">{title}</title_local>
+            <title_english label="English title">{title}</title_english><title_custom label="Custom title">{title}</title_custom></titles>
+            <film_info><runtime><seconds>{runtime}</seconds></runtime><completion_date><year>{year}</year></completion_date>
+            <premiere_type label="Premiere">International</premiere_type><online_trailer_url label="Trailer">http://trailers.example/{id}</online_trailer_url>
+            <youtube_url label="Youtube"></youtube_url><estimated_budget label="Budget">{id}.jpg</estimated_budget>
+            {countries}{languages}{subtitles}<types>{types}</types>
+            <texts><directors_statement label="Statement">{keywords}</directors_statement><logline label="Logline">{logline}</logline></texts></film_info>
+            <publications>{en}{et}{ru}</publications></film>""".format(
+            id=film_id, title=escape(text(rnd, 3)), runtime=rnd.randint(600, 10000), year=rnd.randint(1950, 2019),
+            countries=tags('countries', 'country', rnd.sample(COUNTRIES, rnd.randint(1, 3))),
+            languages=tags('languages', 'language', rnd.sample(LANGUAGES, rnd.randint(1, 2))),
+            subtitles=tags('subtitle_languages', 'subtitle_language', rnd.sample(LANGUAGES, rnd.randint(1, 2))),
+            types=''.join('<type>{genre}</type>'.format(genre=genre) for genre in rnd.sample(GENRES, rnd.randint(1, 3))),
+            keywords=', '.join(rnd.sample(KEYWORDS, rnd.randint(0, 4))),
+            logline=','.join(str(FIRST_FILM_ID + rnd.randrange(self.films)) for i in range(rnd.randint(0, 3)) if rnd.random() < 0.1),
+            en=publication('en'), et=publication('et'), ru=publication('ru')).encode()
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """ Local HTTP server answering like Eventival from a Festival, with keep-alive and ETags """
+    daemon_threads = True
+
+    def __init__(self, festival, latency=0.0):
+        self.festival = festival
+        self.latency = latency
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}/ws'.format(port=self.server_address[1])
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # headers and body are sent separately, don't wait for delayed ACKs
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        path = self.path.split('?')[0]
+        body = server.festival.get(path[len('/ws'):]) if path.startswith('/ws/') else None
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"{length}-{hash}"'.format(length=len(body), hash=hash(body) & 0xffffffff)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.requests += 1
+            server.bytes += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(films, args):
+    """ one benchmark run at the scale of films, in a fresh process """
+    start = time.perf_counter()
+    festival = Festival(films, args.overlap, args.screenings)
+    generated = time.perf_counter() - start
+    server = StandIn(festival, args.latency / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            result_fn = os.path.join(workdir, 'result.json')
+            env = dict(os.environ, EVENTIVAL_URL=server.url)
+            env.setdefault('EVENTIVAL_CACHE_MB', '0')
+            env.setdefault('EVENTIVAL_SNAPSHOT', 'none')
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', result_fn],
+                                   cwd=workdir, env=env, stdout=subprocess.DEVNULL if not args.verbose else None)
+            if child.returncode:
+                raise RuntimeError('Run with {films} films failed with exit code {code}'.format(films=films, code=child.returncode))
+            with open(result_fn) as result_file:
+                result = json.load(result_file)
+    finally:
+        server.shutdown()
+        server.server_close()
+    result.update({
+        'films': films,
+        'screenings': films * args.screenings,
+        'generate_seconds': round(generated, 3),
+        'http_requests': server.requests,
+        'http_bytes': server.bytes,
+        'films_per_second': round(films / result['seconds'], 1) if result['seconds'] else None,
+    })
+    return result
+
+
+def child(result_fn):
+    # runs in the benchmark's working directory, EVENTIVAL_URL points to the stand-in
+    sys.path.insert(0, REPO_DIR)
+    start = time.perf_counter()
+    import eventivalfetch
+    imported = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        stages = eventivalfetch.main()
+    seconds = time.perf_counter() - imported
+    with open(result_fn, 'w') as result_file:
+        json.dump({'seconds': round(seconds, 3),
+                   'import_seconds': round(imported - start, 3),
+                   'stages': {stage: round(value, 3) for stage, value in sorted(stages.items())},
+                   'connections': eventivalfetch.pool.stats()}, result_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--films', type=int, nargs='+', default=[100, 1000], help='scales to run, 100 to 20000 films')
+    parser.add_argument('--screenings', type=int, default=2, help='screenings per film')
+    parser.add_argument('--overlap', type=float, default=0.1, help='share of films listed in two subfests')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds the stand-in waits before every answer')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scale')
+    parser.add_argument('--output', help='JSON file for the results, default stdout')
+    parser.add_argument('--any-host', action='store_true', help='allow a DB that is not on localhost')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the runs')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+
+    if not args.any_host and os.getenv('FILMS_DB_HOST', 'localhost') not in ('localhost', '127.0.0.1', '::1'):
+        parser.error('FILMS_DB_HOST is not local, the benchmark writes to it; use --any-host to run anyway')
+    results = []
+    for films in args.films:
+        for repeat in range(args.repeat):
+            result = run(films, args)
+            print('{films} films: {seconds} s, {films_per_second} films/s'.format(**result), file=sys.stderr)
+            results.append(result)
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {key: value for key, value in sorted(os.environ.items()) if key.startswith('EVENTIVAL_')},
+        'runs': results,
+    }
+    with (open(args.output, 'w') if args.output else contextlib.nullcontext(sys.stdout)) as output:
+        json.dump(report, output, indent=2)
+        output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+import os
+
+
+class BatchWriter:
+    """
+    Collects row tuples per target table and writes them in chunks.
+
+    Tables are registered with table() in the order they have to be written.
+    Rows are queued with add(), deletes with delete() and complete link row
+    sets with sync(); call next_record() after every parsed record and the
+    writer flushes itself after chunk_size records. flush() runs the queued
+    deletes first, then writes every table with multi-row INSERT statements
+    of at most chunk_size rows and about max_bytes of values, well below the
+    server's max_allowed_packet, and commits once.
+
+    Example:
+        writer = BatchWriter(mydb)
+        writer.table('persons', ('id', 'name'), update=('name',))
+        for person in persons:
+            writer.add('persons', (person['@id'], person['name']))
+            writer.next_record()
+        writer.flush()
+    """
+    def __init__(self, db, chunk_size=500, max_bytes=1024 * 1024):
+        self.db = db
+        self.cursor = db.cursor()
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.tables = {}
+        self.rows = {}
+        self.deletes = {}
+        self.syncs = {}
+        self.callbacks = []
+        self.records = 0
+
+    def table(self, name, columns, update=(), SQL=None, now=()):
+        """
+        Register a target table.
+
+        Args:
+            name: Table name; any unique name when SQL is given.
+            columns: Column names, in the order of the row tuples.
+            update: Columns to overwrite ON DUPLICATE KEY.
+            SQL: Statement to run with executemany instead of a multi-row
+                INSERT, for rows that need a lookup in another table.
+            now: Columns set to now() on insert and update, not part of the
+                row tuples.
+        """
+        self.tables[name] = {'columns': tuple(columns), 'update': tuple(update), 'SQL': SQL, 'now': tuple(now)}
+        self.rows[name] = []
+        self.deletes[name] = {}
+        self.syncs[name] = (None, {})
+        return self
+
+    def add(self, name, row):
+        self.rows[name].append(tuple(row))
+
+    def delete(self, name, column, key):
+        """ queue DELETE FROM name WHERE column = key """
+        self.deletes[name].setdefault(column, []).append(key)
+
+    def sync(self, name, column, key, rows):
+        """
+        Make the rows of name WHERE column = key equal to rows.
+
+        On flush the existing rows of every key synced since the last flush
+        are read with one query per table; only the missing rows are inserted
+        and only the rows that are gone are deleted.
+        """
+        self.syncs[name] = (column, self.syncs[name][1])
+        self.syncs[name][1][key] = [tuple(row) for row in rows]
+
+    def after_commit(self, callback):
+        """ call callback() once the rows queued so far are committed """
+        self.callbacks.append(callback)
+
+    def next_record(self):
+        self.records += 1
+        if self.records >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        stale = {name: self._diff(name) for name in self.tables}
+        for name in self.tables:
+            for column, keys in self.deletes[name].items():
+                self._delete(name, column, keys)
+            self.deletes[name] = {}
+            self._delete_rows(name, stale[name])
+        for name in self.tables:
+            self._insert(name, self.rows[name])
+            self.rows[name] = []
+        self.db.commit()
+        self.records = 0
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def _chunks(self, rows, sized=False):
+        # lists of at most chunk_size rows, with sized also of at most max_bytes
+        chunk = []
+        size = 0
+        for row in rows:
+            row_size = _size(row) if sized else 0
+            if chunk and (len(chunk) >= self.chunk_size or size + row_size > self.max_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(row)
+            size += row_size
+        if chunk:
+            yield chunk
+
+    def _delete(self, name, column, keys):
+        for chunk in self._chunks(keys):
+            SQL = 'DELETE FROM {table} WHERE {column} IN ({keys});'.format(
+                table=name, column=column, keys=', '.join(['%s'] * len(chunk)))
+            self.cursor.execute(SQL, chunk)
+
+    def _diff(self, name):
+        # queue the missing rows of synced keys, return the stale ones
+        column, synced = self.syncs[name]
+        if not synced:
+            return []
+        columns = self.tables[name]['columns']
+        existing = {}
+        for chunk in self._chunks(list(synced)):
+            SQL = 'SELECT {columns} FROM {table} WHERE {column} IN ({keys});'.format(
+                columns=', '.join(columns), table=name, column=column, keys=', '.join(['%s'] * len(chunk)))
+            self.cursor.execute(SQL, chunk)
+            for row in self.cursor.fetchall():
+                existing[_comparable(row)] = row
+        wanted = {}
+        for rows in synced.values():
+            for row in rows:
+                wanted.setdefault(_comparable(row), row)
+        self.rows[name].extend(row for key, row in wanted.items() if key not in existing)
+        self.syncs[name] = (None, {})
+        return [row for key, row in existing.items() if key not in wanted]
+
+    def _delete_rows(self, name, rows):
+        match = '(' + ' AND '.join('{column} <=> %s'.format(column=column) for column in self.tables[name]['columns']) + ')'
+        for chunk in self._chunks(rows, sized=True):
+            SQL = 'DELETE FROM {table} WHERE {matches};'.format(table=name, matches=' OR '.join([match] * len(chunk)))
+            self.cursor.execute(SQL, [value for row in chunk for value in row])
+
+    def _insert(self, name, rows):
+        spec = self.tables[name]
+        for chunk in self._chunks(rows, sized=True):
+            if spec['SQL']:
+                self.cursor.executemany(spec['SQL'], chunk)
+                continue
+            row_format = '(' + ', '.join(['%s'] * len(spec['columns']) + ['now()'] * len(spec['now'])) + ')'
+            SQL = 'INSERT IGNORE INTO {table} ({columns}) VALUES {rows}'.format(
+                table=name, columns=', '.join(spec['columns'] + spec['now']), rows=', '.join([row_format] * len(chunk)))
+            self.cursor.execute(SQL + _on_duplicate(spec) + ';', [value for row in chunk for value in row])
+
+
+def _on_duplicate(spec):
+    if not spec['update'] and not spec['now']:
+        return ''
+    return ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+        ['{column}=VALUES({column})'.format(column=column) for column in spec['update']] +
+        ['{column}=now()'.format(column=column) for column in spec['now']])
+
+
+class StagingWriter(BatchWriter):
+    """
+    BatchWriter for bulk rebuilds, rows go to per-table TSV files in directory.
+
+    Every writer of a run can share one StagingWriter: tables keep their first
+    registration and flush() only flushes the files. Nothing reaches the DB
+    until load(), which loads every file with LOAD DATA LOCAL INFILE ... REPLACE
+    into a temporary staging table LIKE its target (a row staged later wins over
+    an earlier one with the same key, like an upsert) and then merges all of
+    them in one transaction: the deleted and synced keys are deleted first, then every
+    table is written with one INSERT ... SELECT in registration order. Tables
+    registered with SQL are kept in memory and run with executemany in the
+    same transaction. The connection needs allow_local_infile=True and the
+    server local_infile=ON.
+
+    Example:
+        writer = StagingWriter(mydb, 'data/staging')
+        writer.table('persons', ('id', 'name'), update=('name',))
+        for person in persons:
+            writer.add('persons', (person['@id'], person['name']))
+        writer.load()
+    """
+    def __init__(self, db, directory, chunk_size=500, max_bytes=1024 * 1024):
+        super().__init__(db, chunk_size, max_bytes)
+        self.directory = directory
+        self.files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def table(self, name, columns, update=(), SQL=None, now=()):
+        if name in self.tables:
+            return self
+        super().table(name, columns, update, SQL, now)
+        if SQL is None:
+            self.files[name] = open(self._path(name), 'w', encoding='utf-8', newline='')
+        return self
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.tsv')
+
+    def add(self, name, row):
+        if name not in self.files:
+            return super().add(name, row)
+        self.files[name].write('\t'.join(_tsv(value) for value in row) + '\n')
+
+    def sync(self, name, column, key, rows):
+        # a rebuild replaces the rows of every synced key
+        self.delete(name, column, key)
+        for row in rows:
+            self.add(name, row)
+
+    def next_record(self):
+        pass
+
+    def flush(self):
+        for staging_file in self.files.values():
+            staging_file.flush()
+
+    def load(self):
+        """ write everything staged so far to the DB and commit """
+        for staging_file in self.files.values():
+            staging_file.close()
+        for name in self.files:
+            spec = self.tables[name]
+            self.cursor.execute('DROP TEMPORARY TABLE IF EXISTS staging_{table};'.format(table=name))
+            self.cursor.execute('CREATE TEMPORARY TABLE staging_{table} LIKE {table};'.format(table=name))
+            self.cursor.execute("""LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE staging_{table}
+                CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'
+                ({columns});""".format(table=name, columns=', '.join(spec['columns'])), (os.path.abspath(self._path(name)),))
+
+        for name in self.tables:
+            for column, keys in self.deletes[name].items():
+                self._delete(name, column, list(dict.fromkeys(keys)))
+            self.deletes[name] = {}
+        for name in self.tables:
+            spec = self.tables[name]
+            if name not in self.files:
+                self._insert(name, self.rows[name])
+                self.rows[name] = []
+                continue
+            SQL = 'INSERT IGNORE INTO {table} ({columns}) SELECT {values} FROM staging_{table}'.format(
+                table=name, columns=', '.join(spec['columns'] + spec['now']),
+                values=', '.join(spec['columns'] + ('now()',) * len(spec['now'])))
+            self.cursor.execute(SQL + _on_duplicate(spec) + ';')
+        self.db.commit()
+
+        for name in self.files:
+            self.cursor.execute('DROP TEMPORARY TABLE IF EXISTS staging_{table};'.format(table=name))
+            self.files[name] = open(self._path(name), 'w', encoding='utf-8', newline='')
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def _tsv(value):
+    # LOAD DATA default escaping
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+        .replace('\r', '\\r').replace('\0', '\\0'))
+
+
+def _size(row):
+    # rough bytes of row in a statement: the values and a quote, comma or so each
+    return sum(4 if value is None else len(str(value).encode()) + 3 for value in row)
+
+
+def _comparable(row):
+    # DB returns ints where the feed has strings
+    return tuple(None if value is None else str(value) for value in row)
+
+
+class Codebook:
+    """
+    Write-through cache of a codebook table, loaded with one query.
+
+    Entries map key to value, e.g. relations name -> id or c_program id -> est.
+    Keys match case-insensitively, like the _ci collation of the tables; a key
+    the cache misses is looked up in the DB once, so that whatever else the
+    collation folds still matches. put() and id() only write when the key is
+    missing. Give it an autocommit connection of its own when several
+    processes write the same codebook, so that a miss is committed at once
+    instead of holding locks until the next flush of a batch.
+
+    Args:
+        db: Connection, autocommit unless the caller commits the misses.
+        table: Codebook table.
+        key: Column to look entries up by.
+        value: Column to cache with them, None for a plain set of keys.
+    """
+    def __init__(self, db, table, key, value=None):
+        # mysql.connector cursors only hold a weak reference to their connection
+        self.db = db
+        self.table = table
+        self.key = key
+        self.value = value
+        self.cursor = db.cursor()
+        self.columns = key if value is None else key + ', ' + value
+        self.cursor.execute('SELECT {columns} FROM {table};'.format(columns=self.columns, table=table))
+        self.entries = {}
+        for row in self.cursor.fetchall():
+            self.entries[_folded(row[0])] = row[1] if value else None
+        self.missing = set()
+
+    def __contains__(self, key):
+        return self._lookup(key)
+
+    def get(self, key, default=None):
+        return self.entries[_folded(key)] if self._lookup(key) else default
+
+    def put(self, key, value=None, update=False):
+        """ INSERT IGNORE key (and value) unless cached; with update a changed value is rewritten """
+        if self._lookup(key) and (not update or self.entries[_folded(key)] == value):
+            return
+        if self.value is None:
+            SQL = 'INSERT IGNORE INTO {table} ({key}) VALUES (%s);'.format(table=self.table, key=self.key)
+            self.cursor.execute(SQL, (key,))
+        else:
+            SQL = 'INSERT IGNORE INTO {table} ({key}, {value}) VALUES (%s, %s)'.format(
+                table=self.table, key=self.key, value=self.value)
+            if update:
+                SQL += ' ON DUPLICATE KEY UPDATE {value}=VALUES({value})'.format(value=self.value)
+            self.cursor.execute(SQL + ';', (key, value))
+        self.entries[_folded(key)] = value
+        self.missing.discard(_folded(key))
+
+    def id(self, key):
+        """
+        value (the auto increment id) of key, inserting key when it is new;
+        None if the DB stored key as something else, e.g. truncated
+        """
+        if not self._lookup(key):
+            self.cursor.execute('INSERT IGNORE INTO {table} ({key}) VALUES (%s);'.format(table=self.table, key=self.key), (key,))
+            self.missing.discard(_folded(key))
+            if not self._lookup(key):
+                print('- {key!r} is not in {table} after INSERT IGNORE, skipped'.format(key=key, table=self.table))
+                return None
+        return self.entries[_folded(key)]
+
+    def _lookup(self, key):
+        # whether key is cached, looking a miss up in the DB once
+        folded = _folded(key)
+        if folded in self.entries:
+            return True
+        if folded in self.missing:
+            return False
+        self.cursor.execute('SELECT {columns} FROM {table} WHERE {key} = %s;'.format(
+            columns=self.columns, table=self.table, key=self.key), (key,))
+        rows = self.cursor.fetchall()
+        if not rows:
+            self.missing.add(folded)
+            return False
+        self.entries[folded] = rows[0][1] if self.value else None
+        return True
+
+
+def _folded(key):
+    # codebook keys compare case-insensitively, like the table collation
+    return str(key).casefold()
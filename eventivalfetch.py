@@ -2,15 +2,45 @@ import os, sys
 import urllib.request, json, csv
 
 import time
+import hashlib
+import itertools
+import contextlib
+import threading
+import queue
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import wraps
 
 import xmltodict
 
-from bs4 import BeautifulSoup
+import normalize
+from dbwriter import BatchWriter, StagingWriter, Codebook
+from mapping import Mapping, accessor
+from httpcache import ResponseCache
+from httppool import ConnectionPool
+from replay import Replay
+from snapshot import SnapshotWriter
+import textclean
+from metrics import registry, MeteredConnection, CountingReader
 
 interesting_film_id = None # 521116
 
 ANXIETY = 15 * 60; # time in seconds that will make a film anxious and willing to look for updates
+INCREMENTAL = os.getenv('EVENTIVAL_INCREMENTAL', '0') != '0' # skip fresh and unchanged films
+FETCH_WORKERS = int(os.getenv('EVENTIVAL_FETCH_WORKERS', 1)) # films downloaded in parallel, 1 = one after another
+BATCH_SIZE = int(os.getenv('EVENTIVAL_BATCH_SIZE', 500)) # records per commit and rows per multi-row INSERT
+STREAMING = os.getenv('EVENTIVAL_STREAMING', '0') != '0' # parse feeds item by item instead of as a whole document
+BULK = os.getenv('EVENTIVAL_BULK', '0') != '0' # full rebuild: stage all rows in TSV files and LOAD DATA them in one transaction
+METRICS = os.getenv('EVENTIVAL_METRICS') # file for the run metrics, Prometheus text if it ends with .prom, else JSON
+METRICS_INTERVAL = float(os.getenv('EVENTIVAL_METRICS_INTERVAL', 0)) # seconds between rewrites of METRICS during the run, 0 = at the end only; parallel workers rewrite a METRICS file of their own, e.g. metrics.worker-1234.prom
+
+get_text = textclean.get_text
+mySoap = textclean.mySoap
+
+def metered(name, **labels):
+    # timings finer than a stage, per record, only when the METRICS are written
+    return registry.timer(name, **labels) if METRICS else contextlib.nullcontext()
 
 def retry(exceptions, tries=4, delay=3, backoff=2, logger=None):
     """
@@ -32,6 +62,7 @@ def retry(exceptions, tries=4, delay=3, backoff=2, logger=None):
                 try:
                     return f(*args, **kwargs)
                 except exceptions as e:
+                    registry.inc('retries_total', function=f.__name__)
                     msg = '{}, Retrying in {} seconds...'.format(e, mdelay)
                     if logger:
                         logger.warning(msg)
@@ -46,12 +77,46 @@ def retry(exceptions, tries=4, delay=3, backoff=2, logger=None):
 
     return deco_retry
 
+POOL_SIZE = int(os.getenv('EVENTIVAL_POOL_SIZE', 8)) # keep-alive connections kept open to Eventival
+HTTP_TIMEOUT = float(os.getenv('EVENTIVAL_HTTP_TIMEOUT', 60)) # seconds
+pool = ConnectionPool(POOL_SIZE, HTTP_TIMEOUT)
+
 @retry(urllib.error.HTTPError, tries=5, delay=1, backoff=1.2)
 def urlopen_with_retry(userUrl):
-    return urllib.request.urlopen(userUrl)
+    # a 304 answer to a conditional request comes back as a response, not an error
+    with registry.timer('http_request_seconds'):
+        try:
+            response = pool.urlopen(userUrl)
+        except urllib.error.HTTPError as e:
+            registry.inc('http_responses_total', status=e.code)
+            raise
+    registry.inc('http_responses_total', status=response.status)
+    return CountingReader(response, registry, 'http_bytes_total')
 
 
 datadir = 'data'
+eventival_url = os.getenv('EVENTIVAL_URL', 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS')
+CACHE_MB = int(os.getenv('EVENTIVAL_CACHE_MB', 0)) # size of the HTTP response cache in datadir, e.g. 512; 0 = no cache
+REFRESH = os.getenv('EVENTIVAL_REFRESH', '0') != '0' # fetch everything in full, even if not modified
+SNAPSHOT = os.getenv('EVENTIVAL_SNAPSHOT', 'json') # format of the payload dumps in datadir: indent, json, gzip, zstd, archive or none
+RUN = time.strftime('%Y%m%d-%H%M%S')
+snapshots = SnapshotWriter(datadir, SNAPSHOT, run=RUN)
+REPLAY = os.getenv('EVENTIVAL_REPLAY') # directory of recorded responses to use instead of Eventival, e.g. data/http
+replay = Replay(REPLAY, eventival_url) if REPLAY else None
+cache = ResponseCache(os.path.join(datadir, 'http'), urlopen_with_retry, CACHE_MB * 1024 * 1024, REFRESH) if CACHE_MB and not replay else None
+
+def fetch(userUrl):
+    # binary file with the body of userUrl, None if cached and not modified
+    if replay:
+        return replay.open(userUrl)
+    if cache:
+        return cache.open(userUrl)
+    return urlopen_with_retry(userUrl)
+
+def timed(stage):
+    # seconds spent per stage of the run; a stage run in worker threads adds up the time of every thread
+    return registry.timer('stage_seconds', stage=stage)
+
 db = {
     'host': os.getenv('FILMS_DB_HOST'),
     'user': os.getenv('FILMS_DB_USER'),
@@ -62,14 +127,48 @@ import mysql.connector
 
 # rint(db)
 
-mydb = mysql.connector.connect(
-  host = db['host'],
-  user = db['user'],
-  passwd = db['passwd'],
-  database = db['database']
-)
+def connect(autocommit=False):
+    return MeteredConnection(mysql.connector.connect(
+      host = db['host'],
+      user = db['user'],
+      passwd = db['passwd'],
+      database = db['database'],
+      allow_local_infile = BULK,
+      autocommit = autocommit
+    ), registry)
+
+def load_codebooks():
+    # codebook misses are committed right away on their own connection, they must not
+    # wait for the next flush while other workers insert the same keyword or genre
+    codebook_db = connect(autocommit=True)
+    return {
+        'relations':  Codebook(codebook_db, 'relations', 'name', 'id'),
+        'c_keyword':  Codebook(codebook_db, 'c_keyword', 'est', 'id'),
+        'c_genre':    Codebook(codebook_db, 'c_genre', 'est'),
+        'c_program':  Codebook(codebook_db, 'c_program', 'id', 'est'),
+        'c_poffFest': Codebook(codebook_db, 'c_poffFest', 'id', 'est'),
+    }
+
+mydb = connect()
 # rint(mydb)
 mycursor = mydb.cursor()
+codebooks = load_codebooks()
+staging = StagingWriter(mydb, os.path.join(datadir, 'staging'), BATCH_SIZE) if BULK else None
+
+def new_writer():
+    # in bulk mode every parse_* stages its rows in the one StagingWriter, loaded at the end of the run
+    return staging or BatchWriter(mydb, BATCH_SIZE)
+
+def mark_done(userUrl):
+    # a cached body counts as processed once its rows are committed
+    if not cache:
+        return
+    if staging:
+        staging.after_commit(lambda: cache.done(userUrl))
+    else:
+        cache.done(userUrl)
+
+PROCESSES = int(os.getenv('EVENTIVAL_PROCESSES', 1)) # subfests synced in parallel worker processes
 
 # Eventival subfestival codes
 subfests = {
@@ -84,17 +183,17 @@ subfests = {
 if interesting_film_id:
     tasks = {
         'venues' : {
-            'url': 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/venues.xml',
+            'url': eventival_url + '/venues.xml',
             'json': 'venues.json',
             'root_path': 'venues.venue'
         },
         'publications' : {
-            'url': 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/films/publications-locked.xml',
+            'url': eventival_url + '/films/publications-locked.xml',
             'json': 'publications.json',
             'root_path': 'films.item'
         },
         'screenings' : {
-            'url': 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/films/screenings.xml',
+            'url': eventival_url + '/films/screenings.xml',
             'json': 'screenings.json',
             'root_path': 'screenings.screening'
         }
@@ -102,55 +201,71 @@ if interesting_film_id:
 else:
     tasks = {
         'venues' : {
-            'url': 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/venues.xml',
+            'url': eventival_url + '/venues.xml',
             'json': 'venues.json',
             'root_path': 'venues.venue'
         },
         'publications' : {
-            # 'url': 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/films/publications-locked.xml',
-            'url': 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/films/categories/{subfest}/publications-locked.xml',
+            # 'url': eventival_url + '/films/publications-locked.xml',
+            'url': eventival_url + '/films/categories/{subfest}/publications-locked.xml',
             'json': 'publications.json',
             'root_path': 'films.item'
         },
         'screenings' : {
-            # 'url': 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/films/screenings.xml',
-            'url': 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/films/categories/{subfest}/screenings.xml',
+            # 'url': eventival_url + '/films/screenings.xml',
+            'url': eventival_url + '/films/categories/{subfest}/screenings.xml',
             'json': 'screenings.json',
             'root_path': 'screenings.screening'
         }
     }
 
-def clean_empty(d, needle):
-    if not isinstance(d, (dict, list)):
-        return d
-    if isinstance(d, list):
-        return [v for v in (clean_empty(v, needle) for v in d) if v]
-    return {k: v for k, v in ((k, clean_empty(v, needle)) for k, v in d.items()) if v and k != needle}
-
-import re
-findquotes = re.compile(r'"([^"]*)"')
-find_brs = re.compile(r'<br[^>]*>')
-def mySoap(text):
-
-    def curly(m):
-        return '“' + m.group(1) + '”'
-
-    if not text:
-        return ''
-    text = text.replace('</p>', '||BR||')
-    # rint(text + '\n*****')
-    text = findquotes.sub(curly, text)
-    # rint(text + '\n*****')
-    text = find_brs.sub('||BR||', text)
-    # rint(text + '\n*****')
-    paragraphs = text.split('||BR||')
-    paragraphs = [BeautifulSoup(p, features="html.parser").get_text().strip() for p in paragraphs]
-    paragraphs = filter(None, paragraphs)
-    text = '\n'.join(paragraphs)
-    paragraphs = text.split('\n')
-    paragraphs = [p.strip() for p in paragraphs]
-    paragraphs = filter(None, paragraphs)
-    return "<p>" + "</p>\n<p>".join(paragraphs) + "</p>"
+def iter_items(stream, root_path):
+    """
+    Yield the elements at root_path of the XML in stream one by one,
+    normalized the same way fetch_base normalizes the whole document.
+
+    xmltodict parses the stream in a thread and hands over each item as soon
+    as it is closed; at most 100 items wait in the queue, so memory stays
+    flat no matter how big the feed is.
+    """
+    items = queue.Queue(maxsize=100)
+    stop = threading.Event()
+    done = object()
+
+    def callback(path, item):
+        if [name for name, attrs in path] != root_path or not item:
+            return True
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def parse():
+        try:
+            # includes the time spent waiting for the queue to make room
+            with registry.timer('xml_parse_seconds', document='feed'):
+                normalize.parse(stream, drop=('hash',), item_depth=len(root_path), item_callback=callback)
+            items.put(done)
+        except xmltodict.ParsingInterrupted:
+            pass
+        except Exception as e:
+            items.put(e)
+
+    parser = threading.Thread(target=parse, daemon=True)
+    parser.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
 
 
 def fetch_base(subfest = None):
@@ -161,543 +276,526 @@ def fetch_base(subfest = None):
             userUrl = tasks[task]['url']
         else:
             userUrl = tasks[task]['url'].format(subfest=subfest)
-        json_fn = os.path.join(datadir, str(subfest) + '_' + tasks[task]['json'])
-        print('Fetch ' + userUrl + ' to ' + json_fn)
+        snapshot = str(subfest) + '_' + os.path.splitext(tasks[task]['json'])[0]
+        print('Fetch ' + userUrl + ' to ' + snapshots.path(snapshot))
+
+        with timed('fetch'):
+            response = fetch(userUrl)
+        # a film can change while the listing stays the same: the listed films of an
+        # unchanged publications feed are still revalidated, only the feed's own rows are skipped
+        unchanged = response is None
+        options = {'unchanged': True} if unchanged else {}
+        if unchanged and task == 'publications':
+            print('- Not modified since last sync, revalidating its films')
+            response = cache.cached(userUrl)
+        if response is None:
+            print('- Not modified since last sync')
+            continue
 
-        with urlopen_with_retry(userUrl) as url:
+        if STREAMING:
+            # fetching, parsing and writing are interleaved, only the task total is timed
+            with response as url, timed('task ' + task):
+                items = iter_items(url, root_path)
+                first = next(items, None)
+                if first is None:
+                    print('#### Got no {root_path} items'.format(root_path=tasks[task]['root_path']))
+                    return
+                items = itertools.chain([first], items)
+                globals()['parse_' + task](items if unchanged else snapshots.dump_items(snapshot, items), task, **options)
+            if not unchanged:
+                mark_done(userUrl)
+            continue
+
+        with response as url, timed('fetch'):
             data = url.read()
             # rint('Got {len} bytes worth of HTTP data'.format(len=len(data)))
         XML_data = data.decode()
         # rint('Got {len} bytes worth of XML_data'.format(len=len(XML_data)))
 
-        dict_data = clean_empty(xmltodict.parse(XML_data), '')
+        with timed('xml'), registry.timer('xml_parse_seconds', document='feed'):
+            dict_data = normalize.parse(XML_data, drop=('hash',))
         for elem in root_path:
             dict_data = dict_data.get(elem,{})
-        dict_data = clean_empty(dict_data, 'hash')
 
         if dict_data == {}:
             print('#### Got just {len} bytes worth of JSON'.format(len=len(json.dumps(dict_data))))
             return
 
-        with open(json_fn, 'w') as json_file:
-            json.dump(dict_data, json_file, indent=4)
-            # rint ('Done with ' + json_fn)
+        if not unchanged:
+            with timed('snapshot'):
+                snapshots.write(snapshot, dict_data)
 
-        globals()['parse_' + task](dict_data, task)
+        with timed('task ' + task):
+            globals()['parse_' + task](dict_data, task, **options)
+        if not unchanged:
+            mark_done(userUrl)
 
 
+VENUE = Mapping([
+    ('id',         'id'),
+    ('name',       'name'),
+    ('company',    'company'),
+    ('company_id', 'company_id'),
+    ('city',       'company_contact.address.city'),
+])
+
 def parse_venues(dict_data, task):
     print('Parse ' + task)
-    if not isinstance(dict_data, list):
+    if isinstance(dict_data, dict):
         dict_data = [dict_data]
 
     # return
-    queries = [
-        {
-            'mappings': {
-                'id': 'id',
-                'name': 'name',
-                'company': 'company',
-                'company_id': 'company_id',
-                'city': 'company_contact.address.city'
-            },
-            'SQL': """INSERT IGNORE INTO venues (id, name, company, company_id, city)
-                VALUES (%(id)s, %(name)s, %(company)s, %(company_id)s, %(city)s)
-                ON DUPLICATE KEY UPDATE
-                name=%(name)s, company=%(company)s, company_id=%(company_id)s, city=%(city)s
-            ;"""
-        }
-    ]
+    SQL = """INSERT IGNORE INTO venues (id, name, company, company_id, city)
+        VALUES (%(id)s, %(name)s, %(company)s, %(company_id)s, %(city)s)
+        ON DUPLICATE KEY UPDATE
+        name=%(name)s, company=%(company)s, company_id=%(company_id)s, city=%(city)s
+    ;"""
 
     for item in dict_data:
-        for query in queries:
-            SQL = query['SQL']
-            mappings = query['mappings']
-            # rint('item:', item)
-            map = {}
-            for mapping in mappings:
-                path = mappings[mapping].split('.')
-                elem = path.pop(0)
-                # rint('elem:', elem)
-                # if elem in item:
-                    # value = item[elem]
-                value = item.get(elem,{})
-                # rint('value:', value)
-                for elem in path:
-                    value = value.get(elem,{})
-                    # if value and elem in value:
-                # rint('map:', mapping, '<-', mappings[mapping], ' = ', value)
-                if value == {}:
-                    value = None;
-                map[mapping] = value
-            if SQL:
-                # rint(map)
-                mycursor.execute(SQL, map)
-                # rint(mycursor.statement)
+        map = VENUE.map(item)
+        with timed('db'):
+            mycursor.execute(SQL, map)
+        # rint(mycursor.statement)
         # rint('commit')
-        mydb.commit()
+        with timed('db'):
+            mydb.commit()
 
 
 film_counter = 0
-def parse_publications(dict_data, task):
+duplicate_films = 0
+# film ids fetched in this run; a Manager dict shared by the worker processes when running in parallel
+fetched_films = {}
+claim_tokens = itertools.count()
+# subtitle language codes of the films claimed in this run, {film_id: [code, ...] or None if
+# not parsed}; the screenings take them from here before the DB, where BULK rows only arrive
+# on load() and another worker's rows on its commit. A Manager dict when running in parallel
+film_subtitles = {}
+FILM_WAIT = 600 # seconds the screenings wait for a film another worker is fetching
+
+def film_subtitle_codes(film_id, stored):
+    """ subtitle codes of film_id parsed in this run, else the stored ones """
+    film_id = str(film_id)
+    waited = 0
+    while film_id in fetched_films and film_id not in film_subtitles and waited < FILM_WAIT:
+        time.sleep(0.1)
+        waited += 0.1
+    codes = film_subtitles.get(film_id)
+    return stored.get(film_id, []) if codes is None else codes
+
+def claim_film(film_id):
+    # True for the first appearance of film_id in this run, in any process
+    token = (os.getpid(), next(claim_tokens))
+    return fetched_films.setdefault(str(film_id), token) == token
+
+
+FESTIVALS = accessor('eventival_categorization.categories.category', default=[])
+PROGRAMS = accessor('eventival_categorization.sections.section', default=[])
+
+def parse_publications(dict_data, task, unchanged=False):
+    """ films, titles and categorization of the feed; unchanged: the feed was not modified, only revalidate the films """
     print('Parse ' + task)
-    global film_counter
+    global film_counter, duplicate_films
     # rint('dd', dict_data)
-    if not isinstance(dict_data, list):
+    if isinstance(dict_data, dict):
         dict_data = [dict_data]
         # rint('is list?', isinstance(dict_data, list))
     # return
 
-    SQL = """INSERT IGNORE INTO films (id, title_eng, title_original, published)
-        VALUES (%(id)s, %(title_eng)s, %(title_original)s, subtime(now(),SEC_TO_TIME(86400)))
-        ON DUPLICATE KEY UPDATE
-        title_eng=%(title_eng)s, title_original=%(title_original)s
-    ;"""
-
-    for item in dict_data:
+    writer = films_writer()
+    for item, state, download in prefetch_films(dict_data):
         film_id = item['id']
+
+        # filmFestival / eventival_categorization -> categories -> category
+        for festival in [] if unchanged else FESTIVALS(item):
+            codebooks['c_poffFest'].put(festival['@id'], festival.get('#text'))
+            writer.add('film_poffFest', (film_id, festival['@id']))
+        # filmProgram / eventival_categorization -> sections -> section
+        for program in [] if unchanged else PROGRAMS(item):
+            codebooks['c_program'].put(program['id'], program.get('name'), update=True)
+            writer.add('film_programs', (film_id, program['id']))
+
         # if item['id'] != '521140':
         #     continue
         film_counter += 1
         if interesting_film_id and interesting_film_id != int(film_id):
             print('skip', film_id, '!=', interesting_film_id)
             continue
+        if not claim_film(film_id):
+            # listed in another category too, only the category and program links are added
+            duplicate_films += 1
+            print(film_counter, 'Film', item['id'], 'already fetched in this run')
+            continue
+        if is_fresh(state):
+            print(film_counter, 'Film', item['id'], 'updated {sec} sec ago, skipping'.format(sec=state['last_update_sec']))
+            film_subtitles.setdefault(str(film_id), None)
+            continue
         print(film_counter, 'Film', item['id'], item.get('title_english', 'WARNING, Film has no title_english.          *** *** *** *** ***'))
-        map = { 'id': item['id'],
-                'title_eng': item.get('title_english'),
-                'title_original': item.get('title_original'),
-                'anxiety': ANXIETY
-              }
-        mycursor.execute(SQL, map)
-        # rint(mycursor.statement)
+        if not unchanged:
+            writer.add('film_titles', (item['id'], item.get('title_english'), item.get('title_original')))
 
-        fetch_film(item['id'])
-        mydb.commit()
+        try:
+            with timed('films'):
+                fetch_film(item['id'], download, state, writer)
+        finally:
+            # None: not parsed, the stored subtitle languages are current
+            film_subtitles.setdefault(str(film_id), None)
+        with timed('db'):
+            writer.next_record()
+    with timed('db'):
+        writer.flush()
 
     print('- {film_counter} films committed'.format(film_counter=film_counter))
-
-
-    # filmFestival / eventival_categorization -> categories -> category 
-    SQLs = [
-        """INSERT IGNORE INTO c_poffFest (id, est)
-        VALUES (%(id)s, %(est)s)
-        ;""",
-        """INSERT IGNORE INTO film_poffFest (film_id, poffFest_id)
-        VALUES (%(film_id)s, %(id)s)
-        ;"""
-    ]
-    for item in dict_data:
-        try:
-            festivals = item['eventival_categorization']['categories']['category']
-        except Exception as e:
-            print('No festivals, skipping ', item)
-            continue
-        if not isinstance(festivals, list):
-            festivals = [festivals]
-        for festival in festivals:
-            map = { 'id': festival['@id'], 'est': festival['#text'], 'film_id': item['id'] }
-            for SQL in SQLs:
-                mycursor.execute(SQL, map)
-                # rint(mycursor.statement)
-        mydb.commit()
     print('- Festivals committed')
+    print('- Programs committed')
 
 
-    # filmProgram / eventival_categorization -> sections -> section 
-    SQLs = [
-        """INSERT IGNORE INTO c_program (id, est)
-        VALUES (%(id)s, %(est)s)
-        ON DUPLICATE KEY UPDATE
-        est=%(est)s
-        ;""",
-        """INSERT IGNORE INTO film_programs (film_id, program_id)
-        VALUES (%(film_id)s, %(id)s)
-        ;"""
-        ]
-    for item in dict_data:
-        # try:
-        programs = item['eventival_categorization'].get('sections',{}).get('section',[])
-        # except Exception as e:
-        #     rint('No sections, skipping ', item)
-        #     continue
-
-        if not isinstance(programs, list):
-            programs = [programs]
-        for program in programs:
-            map = { 'id': program['id'], 'est': program['name'], 'film_id': item['id'] }
-            for SQL in SQLs:
-                mycursor.execute(SQL, map)
-                # rint(mycursor.statement)
-        mydb.commit()
-    print('- Programs committed')
+SCREENING = Mapping([
+    ('id',                            'id'),
+    ('screening_code',                'code'),
+    ('film_id',                       'film.id'),
+    ('cinema_hall_id',                'cinema_hall_id'),
+    ('venue_id',                      'venue_id'),
+    ('start_date',                    'start', lambda start: start[:10]),
+    ('start_time',                    'start', lambda start: start[11:]),
+    ('ticketing_url',                 'ticketing_url'),
+    ('screening_duration_minutes',    'duration_screening_only_minutes'),
+    ('presentation_duration_minutes', 'presentation.duration'),
+    ('qa_duration_minutes',           'qa.duration'),
+    ('screening_info_est',            'additional_info.et'),
+    ('screening_info_eng',            'additional_info.en'),
+    ('screening_info_rus',            'additional_info.ru'),
+    # screeningType / type_of_screening
+    ('type_of_screening',             'type_of_screening', None, 'regular'),
+])
+SCREENING_LANGUAGES = accessor('film.languages.print.language', default=[])
+SCREENING_SUBTITLE_LANGUAGES = accessor('film.subtitle_languages.translations.language', default=[])
+
+# (part, role, persons) of the people presenting a screening
+SCREENING_ROLES = [(part, role, accessor(part + '.' + role + 's.person', default=[]))
+    for part in ('presentation', 'qa') for role in ('presenter', 'guest')]
+
+def screening_roles(item):
+    """ (person, relation, part, role) of every person and relation of a screening """
+    for part, role, persons in SCREENING_ROLES:
+        for person in persons(item):
+            for relation in person.get('relations', {}).get('relation', [None]):
+                yield person, relation, part, role
+
+
+# persons {id: name} queued in this run, a guest of many screenings is written once
+persons_written = {}
+
+def add_person(writer, person):
+    if persons_written.get(person['@id']) != person['name']:
+        persons_written[person['@id']] = person['name']
+        writer.add('persons', (person['@id'], person['name']))
+
+
+def screenings_writer():
+    writer = new_writer()
+    writer.table('screenings', SCREENING.columns, update=SCREENING.columns[1:])
+    writer.table('screening_film_languages', ('screening_id', 'language_code'))
+    writer.table('screening_subtitle_languages', ('screening_id', 'language_code'))
+    writer.table('persons', ('id', 'name'), update=('name',))
+    writer.table('screening_persons', ('screening_id', 'person_id', 'relation_id', 'part', 'role'))
+    return writer
 
 
 def parse_screenings(dict_data, task):
     print('Parse ' + task)
-    if not isinstance(dict_data, list):
+    if isinstance(dict_data, dict):
         dict_data = [dict_data]
     # return
 
-    screeningSQL = """INSERT IGNORE INTO screenings ( id
-        , screening_code, film_id, cinema_hall_id, venue_id
-        , start_date, start_time, ticketing_url
-        , screening_duration_minutes, presentation_duration_minutes, qa_duration_minutes
-        , screening_info_est, screening_info_eng, screening_info_rus)
-        VALUES ( %(screening_id)s
-        , %(screening_code)s, %(film_id)s, %(cinema_hall_id)s, %(venue_id)s
-        , %(start_date)s, %(start_time)s, %(ticketing_url)s
-        , %(screening_duration_minutes)s, %(presentation_duration_minutes)s, %(qa_duration_minutes)s
-        , %(screening_info_est)s, %(screening_info_eng)s, %(screening_info_rus)s)
-        ON DUPLICATE KEY UPDATE screening_code=%(screening_code)s
-        , film_id=%(film_id)s, cinema_hall_id=%(cinema_hall_id)s, venue_id=%(venue_id)s
-        , start_date=%(start_date)s, start_time=%(start_time)s, ticketing_url=%(ticketing_url)s
-        , screening_duration_minutes=%(screening_duration_minutes)s
-        , presentation_duration_minutes=%(presentation_duration_minutes)s
-        , qa_duration_minutes=%(qa_duration_minutes)s
-        , screening_info_est=%(screening_info_est)s, screening_info_eng=%(screening_info_eng)s, screening_info_rus=%(screening_info_rus)s
-    ;"""
-    i = 0
-    for item in dict_data:
-        i+=1
-        screening_id = item['id']
-        film_id = item['film']['id']
-        # continue
-        map = { 'screening_id': screening_id
-              , 'screening_code': item.get('code'), 'film_id': film_id, 'cinema_hall_id': item.get('cinema_hall_id'), 'venue_id': item['venue_id']
-              , 'start_date': item['start'][:10], 'start_time': item['start'][11:], 'ticketing_url': item.get('ticketing_url')
-              , 'screening_duration_minutes': item['duration_screening_only_minutes']
-              , 'presentation_duration_minutes': item.get('presentation',{}).get('duration')
-              , 'qa_duration_minutes': item['qa'].get('duration')
-              , 'screening_info_est': item.get('additional_info',{}).get('et')
-              , 'screening_info_eng': item.get('additional_info',{}).get('en')
-              , 'screening_info_rus': item.get('additional_info',{}).get('ru')
-              }
-        mycursor.execute(screeningSQL, map)
-        # rint(i, mycursor.statement)
-
-        # screeningType / type_of_screening
-        SQLs = [
-            # "INSERT IGNORE INTO c_screeningType (code, est) VALUES (%(est)s, %(est)s);",
-            "UPDATE screenings SET type_of_screening = %(type_of_screening)s WHERE id = %(id)s;"
-        ]
-        map = { 'id': screening_id, 'type_of_screening': item.get('type_of_screening', 'regular') }
-        for SQL in SQLs:
-            # rint('got presenter for presentation for screening', SQL, map)
-            mycursor.execute(SQL, map)
-            # rint(mycursor.statement)
-
-        # Film Languages
-        map = { 'screening_id': screening_id }
-        SQL = 'DELETE FROM screening_film_languages WHERE screening_id = %(screening_id)s;'
-        mycursor.execute(SQL, map)
-        SQL = 'INSERT IGNORE INTO screening_film_languages (screening_id, language_code) VALUES (%(screening_id)s, %(ISOLanguage)s);'
-        ISOLanguages = item.get('film',{}).get('languages',{}).get('print',{}).get('language',[])
-        if not isinstance(ISOLanguages, list):
-            ISOLanguages = [ISOLanguages]
-        for ISOLanguage in ISOLanguages:
-            map['ISOLanguage'] = ISOLanguage
-            mycursor.execute(SQL, map)
-
-        # Subtitle Languages
-        # TODO: get language from translations, not print. copy from film subtitle languages, if missing
-        map = { 'screening_id': screening_id }
-        SQL = 'DELETE FROM screening_subtitle_languages WHERE screening_id = %(screening_id)s;'
-        mycursor.execute(SQL, map)
-        SQL = 'INSERT IGNORE INTO screening_subtitle_languages (screening_id, language_code) VALUES (%(screening_id)s, %(ISOLanguage)s);'
-        ISOLanguages = item.get('film',{}).get('subtitle_languages',{}).get('translations',{}).get('language',[])
-        if not isinstance(ISOLanguages, list):
-            ISOLanguages = [ISOLanguages]
-        # rint(ISOLanguages)
-        if len(ISOLanguages):
-            for ISOLanguage in ISOLanguages:
-                map['ISOLanguage'] = ISOLanguage
-                mycursor.execute(SQL, map)
-                # rint(mycursor.statement)
-        else:
-            SQL = """INSERT IGNORE INTO screening_subtitle_languages
-                SELECT %(screening_id)s, language_code
-                FROM film_subtitle_languages
-                WHERE film_id = %(film_id)s
-            ;"""
-            map['film_id'] = film_id
-            mycursor.execute(SQL, map)
-            # rint(mycursor.statement)
-
-
-        mydb.commit()
+    relation_ids = codebooks['relations']
+    writer = screenings_writer()
+    for batch in batches(dict_data, BATCH_SIZE):
+        # screenings without subtitle languages get them from film, the stored ones are read per batch
+        subtitles = [SCREENING_SUBTITLE_LANGUAGES(item) for item in batch]
+        stored_subtitles = stored_subtitle_codes(list({str(item['film']['id']) for item, ISOLanguages in zip(batch, subtitles)
+            if not ISOLanguages and film_subtitles.get(str(item['film']['id'])) is None}))
+        for item, ISOLanguages in zip(batch, subtitles):
+            screening_id = item['id']
+            film_id = item['film']['id']
+            # continue
+            with metered('record_map_seconds', document='screening'):
+                writer.add('screenings', SCREENING.row(item))
+
+            # Film Languages
+            film_languages = SCREENING_LANGUAGES(item)
+            writer.sync('screening_film_languages', 'screening_id', screening_id,
+                [(screening_id, ISOLanguage) for ISOLanguage in film_languages])
+
+            # Subtitle Languages
+            # TODO: get language from translations, not print. copy from film subtitle languages, if missing
+            # rint(ISOLanguages)
+            if not len(ISOLanguages):
+                ISOLanguages = film_subtitle_codes(film_id, stored_subtitles)
+            writer.sync('screening_subtitle_languages', 'screening_id', screening_id,
+                [(screening_id, ISOLanguage) for ISOLanguage in ISOLanguages])
+
+            # Persons
+            screening_persons = []
+            for person, relation, part, role in screening_roles(item):
+                add_person(writer, person)
+                if relation in relation_ids:
+                    screening_persons.append((screening_id, person['@id'], relation_ids.get(relation), part, role))
+            writer.sync('screening_persons', 'screening_id', screening_id, screening_persons)
+
+            with timed('db'):
+                writer.next_record()
+    with timed('db'):
+        writer.flush()
     print('- Screenings committed')
-
-
-    # Persons
-    SQLs = [
-        """INSERT IGNORE INTO persons (id, name)
-        VALUES (%(person_id)s, %(person_name)s)
-        ON DUPLICATE KEY UPDATE name=%(person_name)s
-        ;""",
-        """INSERT IGNORE INTO screening_persons (screening_id, person_id, relation_id, part, role)
-        SELECT %(screening_id)s, %(person_id)s, id, %(part)s, %(role)s
-        FROM relations
-        WHERE name=%(relation_name)s
-        ;"""
-        ]
-    for item in dict_data:
-        map = { 'id':item['id'] }
-        SQL = 'DELETE FROM screening_persons WHERE screening_id = %(id)s;'
-        mycursor.execute(SQL, map)
-        if item['presentation'].get('presenters'):
-            (part, role) = ('presentation', 'presenter')
-            presenters = item['presentation'].get('presenters',{}).get('person')
-            if not isinstance(presenters, list):
-                presenters = [presenters]
-            for presenter in presenters:
-                relations = presenter.get('relations',{}).get('relation')
-                if not isinstance(relations, list):
-                    relations = [relations]
-                for relation in relations:
-                    map = { 'person_id': presenter['@id'], 'person_name': presenter['name'],
-                        'screening_id': item['id'], 'part': part, 'role': role, 'relation_name': relation }
-                    for SQL in SQLs:
-                        # rint('got presenter for presentation for screening', SQL, map)
-                        mycursor.execute(SQL, map)
-                        # rint(mycursor.statement)
-        if item['presentation'].get('guests'):
-            (part, role) = ('presentation', 'guest')
-            guests = item['presentation'].get('guests',{}).get('person')
-            if not isinstance(guests, list):
-                guests = [guests]
-            for guest in guests:
-                relations = guest.get('relations',{}).get('relation')
-                if not isinstance(relations, list):
-                    relations = [relations]
-                for relation in relations:
-                    map = { 'person_id': guest['@id'], 'person_name': guest['name'],
-                        'screening_id': item['id'], 'part': part, 'role': role, 'relation_name': relation }
-                    for SQL in SQLs:
-                        # rint('got guest for presentation for screening', SQL, map)
-                        mycursor.execute(SQL, map)
-                        # rint(mycursor.statement)
-        if item['qa'].get('presenters'):
-            (part, role) = ('qa', 'presenter')
-            presenters = item['qa'].get('presenters',{}).get('person')
-            if not isinstance(presenters, list):
-                presenters = [presenters]
-            for presenter in presenters:
-                relations = presenter.get('relations',{}).get('relation')
-                if not isinstance(relations, list):
-                    relations = [relations]
-                for relation in relations:
-                    map = { 'person_id': presenter['@id'], 'person_name': presenter['name'],
-                        'screening_id': item['id'], 'part': part, 'role': role, 'relation_name': relation }
-                    for SQL in SQLs:
-                        # rint('got presenter for qa for screening', SQL, map)
-                        mycursor.execute(SQL, map)
-                        # rint(mycursor.statement)
-        if item['qa'].get('guests'):
-            (part, role) = ('qa', 'guest')
-            guests = item['qa'].get('guests',{}).get('person')
-            if not isinstance(guests, list):
-                guests = [guests]
-            for guest in guests:
-                relations = guest.get('relations',{}).get('relation', '')
-                if not isinstance(relations, list):
-                    relations = [relations]
-                for relation in relations:
-                    map = { 'person_id': guest['@id'], 'person_name': guest['name'],
-                        'screening_id': item['id'], 'part': part, 'role': role, 'relation_name': relation }
-                    for SQL in SQLs:
-                        # rint('got guest for qa for screening', SQL, map)
-                        mycursor.execute(SQL, map)
-                        # rint(mycursor.statement)
-
-        mydb.commit()
-
     print('- Persons committed')
 
 
-def fetch_film(film_id):
-    select_film_SQL = 'SELECT films.*, now()-films.updated AS last_update_sec FROM films WHERE id = %(film_id)s;'
-    film_cursor = mydb.cursor(dictionary=True)
-    film_cursor.execute(select_film_SQL, {'film_id': film_id})
-    myresult = film_cursor.fetchone()
-    # rint(myresult)
-    # rint(myresult['last_update_sec'])
-
-    if not myresult:
-        myresult = {}
-    # if myresult.get('last_update_sec',0) < ANXIETY:
-    #     return myresult
-
-    root_path = 'film'.split('.')
-    userUrl = 'https://eventival.eu/poff/23/en/ws/VYyOdFh8AFs6XBr7Ch30tu12FljKqS/films/{film_id}.xml'.format(film_id=film_id)
+def stored_subtitle_codes(film_ids):
+    """ Stored subtitle codes of the films, in one query: {film_id: [code]} """
+    if not film_ids:
+        return {}
+    SQL = 'SELECT film_id, language_code FROM film_subtitle_languages WHERE film_id IN ({ids});'.format(
+        ids=', '.join(['%s'] * len(film_ids)))
+    lookup_cursor = mydb.cursor()
+    lookup_cursor.execute(SQL, film_ids)
+    codes = {}
+    for (film_id, language_code) in lookup_cursor.fetchall():
+        codes.setdefault(str(film_id), []).append(language_code)
+    return codes
+
+
+def batches(items, size):
+    # lists of up to size items, also of a streamed feed
+    items = iter(items)
+    batch = list(itertools.islice(items, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(items, size))
+
+
+def film_states(film_ids):
+    """ Stored age and XML hash of the films, in one query: {film_id: row} """
+    if not film_ids:
+        return {}
+    SQL = """SELECT id, TIMESTAMPDIFF(SECOND, updated, now()) AS last_update_sec, xml_hash
+        FROM films WHERE id IN ({ids})
+    ;""".format(ids=', '.join(['%s'] * len(film_ids)))
+    state_cursor = mydb.cursor(dictionary=True)
+    state_cursor.execute(SQL, film_ids)
+    return {str(row['id']): row for row in state_cursor.fetchall()}
+
+
+def is_fresh(state):
+    # updated within the ANXIETY window, no need to look for updates yet
+    last_update_sec = state.get('last_update_sec')
+    return INCREMENTAL and last_update_sec is not None and last_update_sec < ANXIETY
+
+
+def prefetch_films(items):
+    """
+    Yield (item, state, download) for every publication item, in feed order.
+
+    state is the stored films row from film_states() (empty unless running
+    INCREMENTAL). With FETCH_WORKERS > 1 the film XML is downloaded and parsed
+    by a pool of FETCH_WORKERS threads, at most two batches ahead of the
+    caller, and download is the (dd, xml_hash) result of download_film.
+    All DB writes stay with the caller, in feed order.
+    download is None for skipped and fresh films and when fetching one film
+    at a time; fetch_film then downloads the film itself.
+    """
+    executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS) if FETCH_WORKERS > 1 else None
+    batch_size = max(FETCH_WORKERS, 10)
+
+    def submit(batch):
+        states = film_states([item['id'] for item in batch]) if INCREMENTAL else {}
+        submitted = []
+        for item in batch:
+            state = states.get(str(item['id']), {})
+            future = None
+            if (executor and not is_fresh(state) and str(item['id']) not in fetched_films
+                    and not (interesting_film_id and interesting_film_id != int(item['id']))):
+                future = executor.submit(download_film, item['id'])
+            submitted.append((item, state, future))
+        return submitted
+
+    def results(submitted):
+        for item, state, future in submitted:
+            yield item, state, future and future.result()
+
+    try:
+        pending = collections.deque()
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) < batch_size:
+                continue
+            pending.append(submit(batch))
+            batch = []
+            if len(pending) > 1:
+                yield from results(pending.popleft())
+        if batch:
+            pending.append(submit(batch))
+        while pending:
+            yield from results(pending.popleft())
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+
+film_url = eventival_url + '/films/{film_id}.xml'
+
+def download_film(film_id):
+    # network and XML only, no DB access - safe to call from worker threads
+    with timed('fetch'):
+        response = fetch(film_url.format(film_id=film_id))
+        if response is None:
+            return None, None
+        with response as url:
+            data = url.read()
+    xml_hash = hashlib.sha1(data).hexdigest()
+    XML_data = data.decode()
+    with timed('xml'), registry.timer('xml_parse_seconds', document='film'):
+        dd = normalize.parse(XML_data, drop=('@label',))
+    return dd.get('film', {}), xml_hash
+
+
+def crew_index(contacts):
+    """ {type name: [person, ...]} of the crew contacts, in one pass """
+    crew = {}
+    for contact in contacts:
+        name = get_text(contact.get('text') or '')
+        if name:
+            crew.setdefault(contact.get('type', {}).get('name'), []).append(name)
+    return crew
+
+def join_names(names):
+    return ', '.join(names)
+
+# RU fields fall back to EN
+FILM = Mapping([
+    ('title_est',                 'titles.title_local',                                        get_text),
+    ('title_eng',                 'titles.title_english',                                      get_text),
+    ('title_rus',                 ('titles.title_custom', 'titles.title_english'),             get_text),
+    ('title_original',            'titles.title_original',                                     get_text),
+    ('runtime',                   'film_info.runtime.seconds',                                 None, None),
+    ('year',                      'film_info.completion_date.year'),
+    ('premiere_type',             'film_info.premiere_type'),
+    ('trailer_url',               ('film_info.online_trailer_url', 'film_info.youtube_url')),
+    ('directors_bio_est',         'publications.et.directors_bio',                             get_text),
+    ('directors_bio_eng',         'publications.en.directors_bio',                             get_text),
+    ('directors_bio_rus',         ('publications.ru.directors_bio', 'publications.en.directors_bio'), get_text),
+    ('synopsis_est',              'publications.et.synopsis_long',                             mySoap),
+    ('synopsis_eng',              'publications.en.synopsis_long',                             mySoap),
+    ('synopsis_rus',              ('publications.ru.synopsis_long', 'publications.en.synopsis_long'), mySoap),
+    ('extra_image',               'film_info.estimated_budget'),
+    ('extra_text_est',            'publications.et.shooting_formats',                          get_text),
+    ('extra_text_eng',            'publications.en.shooting_formats',                          get_text),
+    ('extra_text_rus',            'publications.ru.shooting_formats',                          get_text),
+    ('directors',                 'publications.en.directors',                                 get_text),
+    ('producers',                 'publications.en.producers',                                 get_text),
+    ('writers',                   'publications.en.writers',                                   get_text),
+    ('cast',                      'publications.en.cast',                                      get_text),
+    # crew_index() of the EN crew, every person of the role
+    ('DoP',                       'crew.Op/DoP',                    join_names, None),
+    ('editors',                   'crew.Mont/Ed',                   join_names, None),
+    ('music',                     'crew.Muusika/Music',             join_names, None),
+    ('production',                'crew.Tootja/Production',         join_names, None),
+    ('distributors',              'crew.Levitaja/Distributor',      join_names, None),
+    ('festivals_est',             'publications.et.synopsis_short',                            get_text),
+    ('festivals_eng',             'publications.en.synopsis_short',                            get_text),
+    ('festivals_rus',             ('publications.ru.festivals', 'publications.en.synopsis_short'), get_text),
+    ('directors_filmography_est', 'publications.en.directors_filmography',                     get_text),
+    ('directors_filmography_eng', 'publications.en.directors_filmography',                     get_text),
+    ('directors_filmography_rus', ('publications.ru.directors_filmography', 'publications.en.directors_filmography'), get_text),
+], default='')
+FILM_COLUMNS = ('id', 'xml_hash') + FILM.columns
+FILM_CREW = accessor('publications.en.crew.contact', default=[])
+FILM_COUNTRIES = accessor('film_info.countries.country', default=[])
+FILM_LANGUAGES = accessor('film_info.languages.language', default=[])
+FILM_SUBTITLE_LANGUAGES = accessor('film_info.subtitle_languages.subtitle_language', default=[])
+FILM_GENRES = accessor('film_info.types.type', default=[])
+FILM_KEYWORDS = accessor('film_info.texts.directors_statement', default='')
+FILM_CASSETTE = accessor('film_info.texts.logline', default='')
+
+def films_writer():
+    writer = new_writer()
+    writer.table('film_titles', ('id', 'title_eng', 'title_original'), SQL="""INSERT IGNORE INTO films (id, title_eng, title_original, published)
+        VALUES (%s, %s, %s, subtime(now(),SEC_TO_TIME(86400)))
+        ON DUPLICATE KEY UPDATE
+        title_eng=VALUES(title_eng), title_original=VALUES(title_original)
+    ;""")
+    writer.table('films', FILM_COLUMNS, update=FILM_COLUMNS[1:], now=('updated',))
+    writer.table('film_countries', ('film_id', 'country_code', 'ordinal'))
+    writer.table('film_languages', ('film_id', 'language_code'))
+    writer.table('film_subtitle_languages', ('film_id', 'language_code'))
+    writer.table('film_genres', ('film_id', 'genre_est'))
+    writer.table('film_keywords', ('film_id', 'keyword_id'))
+    writer.table('film_cassette', ('cassette_id', 'film_id'))
+    writer.table('film_crew', ('film_id', 'role', 'ordinal', 'name'))
+    writer.table('film_poffFest', ('film_id', 'poffFest_id'))
+    writer.table('film_programs', ('film_id', 'program_id'))
+    return writer
+
+
+def fetch_film(film_id, download=None, state=None, writer=None):
+    # link rows go through the caller's films_writer(), committed on its flush
+    standalone = writer is None
+    if standalone:
+        writer = films_writer()
+    if state is None:
+        # not read by the caller with film_states() yet
+        select_film_SQL = 'SELECT films.*, TIMESTAMPDIFF(SECOND, films.updated, now()) AS last_update_sec FROM films WHERE id = %(film_id)s;'
+        film_cursor = mydb.cursor(dictionary=True)
+        film_cursor.execute(select_film_SQL, {'film_id': film_id})
+        state = film_cursor.fetchone() or {}
+    myresult = dict(state)
+    if is_fresh(state):
+        return myresult
+
+    userUrl = film_url.format(film_id=film_id)
     myresult['userUrl'] = userUrl
     # rint('Fetching {title_eng} [{id}] from {userUrl}'.format(**myresult))
 
-    with urlopen_with_retry(userUrl) as url:
-        data = url.read()
-    XML_data = data.decode()
-    dd = xmltodict.parse(XML_data)
-    for elem in root_path:
-        dd = dd[elem]
-    json_fn = os.path.join(datadir, 'films', '{id}.json'.format(id=myresult['id']))
-    with open(json_fn, 'w') as json_file:
-        json.dump(clean_empty(dd, '@label'), json_file, indent=4)
-    # rint ('Done with ' + json_fn)
-
-    SQL = """INSERT IGNORE INTO films (id, updated,
-            title_est, title_eng, title_rus, title_original,
-            runtime, year, premiere_type, trailer_url,
-            directors_bio_est, directors_bio_eng, directors_bio_rus,
-            synopsis_est, synopsis_eng, synopsis_rus,
-            extra_image, extra_text_est, extra_text_eng, extra_text_rus,
-            directors,
-            producers,
-            writers,
-            cast,
-            DoP,
-            editors,
-            music,
-            production,
-            distributors,
-            festivals_est, festivals_eng, festivals_rus,
-            directors_filmography_est, directors_filmography_eng, directors_filmography_rus)
-        VALUES (%(film_id)s, now(),
-            %(title_est)s, %(title_eng)s, %(title_rus)s, %(title_original)s,
-            %(runtime)s, %(year)s, %(premiere_type)s, %(trailer_url)s,
-            %(directors_bio_est)s, %(directors_bio_eng)s, %(directors_bio_rus)s,
-            %(synopsis_est)s, %(synopsis_eng)s, %(synopsis_rus)s,
-            %(extra_image)s, %(extra_text_est)s, %(extra_text_eng)s, %(extra_text_rus)s,
-            %(directors)s,
-            %(producers)s,
-            %(writers)s,
-            %(cast)s,
-            %(DoP)s,
-            %(editors)s,
-            %(music)s,
-            %(production)s,
-            %(distributors)s,
-            %(festivals_est)s, %(festivals_eng)s, %(festivals_rus)s,
-            %(directors_filmography_est)s, %(directors_filmography_eng)s, %(directors_filmography_rus)s)
-        ON DUPLICATE KEY UPDATE
-            updated = now(),
-            title_est = %(title_est)s, title_eng = %(title_eng)s, title_rus = %(title_rus)s, title_original = %(title_original)s,
-            runtime = %(runtime)s, year = %(year)s, premiere_type = %(premiere_type)s, trailer_url = %(trailer_url)s,
-            directors_bio_est = %(directors_bio_est)s, directors_bio_eng = %(directors_bio_eng)s, directors_bio_rus = %(directors_bio_rus)s,
-            synopsis_est = %(synopsis_est)s, synopsis_eng = %(synopsis_eng)s, synopsis_rus = %(synopsis_rus)s,
-            extra_image = %(extra_image)s, extra_text_est = %(extra_text_est)s, extra_text_eng = %(extra_text_eng)s, extra_text_rus = %(extra_text_rus)s,
-            directors = %(directors)s,
-            producers = %(producers)s,
-            writers = %(writers)s,
-            cast = %(cast)s,
-            DoP = %(DoP)s,
-            editors = %(editors)s,
-            music = %(music)s,
-            production = %(production)s,
-            distributors = %(distributors)s,
-            festivals_est = %(festivals_est)s, festivals_eng = %(festivals_eng)s, festivals_rus = %(festivals_rus)s,
-            directors_filmography_est = %(directors_filmography_est)s, directors_filmography_eng = %(directors_filmography_eng)s, directors_filmography_rus = %(directors_filmography_rus)s
-        ;"""
+    if download is None:
+        download = download_film(film_id)
+    dd, xml_hash = download
+    if dd is None:
+        return myresult
+    if cache:
+        writer.after_commit(lambda: cache.done(userUrl))
+    if INCREMENTAL and xml_hash == state.get('xml_hash'):
+        return myresult
+    with timed('snapshot'):
+        snapshots.write('films/{id}'.format(id=film_id), dd)
 
-    def getCrew(crew_a, type):
-        for crew in crew_a:
-            if crew['type']['name'] == type:
-                return BeautifulSoup(crew.get('text') or '', features="html.parser").get_text().strip()
-
-
-
-    map = {'film_id':    film_id,
-        'runtime':       dd['film_info']['runtime']['seconds'],
-        'year':          dd['film_info']['completion_date']['year']         or '',
-        'premiere_type': dd['film_info']['premiere_type'].get('#text')      or '',
-        'trailer_url':   dd['film_info']['online_trailer_url'].get('#text', dd['film_info']['youtube_url'].get('#text')) or '',
-        'directors':                   BeautifulSoup(dd['publications'].get('en',{}).get('directors')             or '', features="html.parser").get_text().strip(),
-        'producers':                   BeautifulSoup(dd['publications'].get('en',{}).get('producers')             or '', features="html.parser").get_text().strip(),
-        'writers':                     BeautifulSoup(dd['publications'].get('en',{}).get('writers')               or '', features="html.parser").get_text().strip(),
-        'cast':                        BeautifulSoup(dd['publications'].get('en',{}).get('cast')                  or '', features="html.parser").get_text().strip(),
-
-        'DoP':                         getCrew(dd['publications'].get('en',{}).get('crew',{}).get('contact',{}), 'Op/DoP'),
-        'editors':                     getCrew(dd['publications'].get('en',{}).get('crew',{}).get('contact',{}), 'Mont/Ed'),
-        'music':                       getCrew(dd['publications'].get('en',{}).get('crew',{}).get('contact',{}), 'Muusika/Music'),
-        'production':                  getCrew(dd['publications'].get('en',{}).get('crew',{}).get('contact',{}), 'Tootja/Production'),
-        'distributors':                getCrew(dd['publications'].get('en',{}).get('crew',{}).get('contact',{}), 'Levitaja/Distributor'),
-
-        'title_original':              BeautifulSoup(dd['titles']['title_original'].get('#text')                  or '', features="html.parser").get_text().strip(),
-        'title_est':                   BeautifulSoup(dd['titles']['title_local'].get('#text')                     or '', features="html.parser").get_text().strip(),
-        'title_eng':                   BeautifulSoup(dd['titles']['title_english'].get('#text')                   or '', features="html.parser").get_text().strip(),
-        'synopsis_est':                mySoap(dd['publications'].get('et',{}).get('synopsis_long','')),
-        'synopsis_eng':                mySoap(dd['publications'].get('en',{}).get('synopsis_long','')),
-        'festivals_est':               BeautifulSoup(dd['publications'].get('et',{}).get('synopsis_short')        or '', features="html.parser").get_text().strip(),
-        'festivals_eng':               BeautifulSoup(dd['publications'].get('en',{}).get('synopsis_short')        or '', features="html.parser").get_text().strip(),
-        'directors_bio_est':           BeautifulSoup(dd['publications'].get('et',{}).get('directors_bio')         or '', features="html.parser").get_text().strip(),
-        'directors_bio_eng':           BeautifulSoup(dd['publications'].get('en',{}).get('directors_bio')         or '', features="html.parser").get_text().strip(),
-        'directors_filmography_est':   BeautifulSoup(dd['publications'].get('en',{}).get('directors_filmography') or '', features="html.parser").get_text().strip(),
-        'directors_filmography_eng':   BeautifulSoup(dd['publications'].get('en',{}).get('directors_filmography') or '', features="html.parser").get_text().strip(),
-        'extra_image':   dd['film_info']['estimated_budget'].get('#text')   or '',
-        'extra_text_est':              BeautifulSoup(dd['publications'].get('et',{}).get('shooting_formats')      or '', features="html.parser").get_text().strip(),
-        'extra_text_eng':              BeautifulSoup(dd['publications'].get('en',{}).get('shooting_formats')      or '', features="html.parser").get_text().strip(),
-        'extra_text_rus':              BeautifulSoup(dd['publications'].get('ru',{}).get('shooting_formats')      or '', features="html.parser").get_text().strip(),
-    }
-    map['title_rus'] =                 BeautifulSoup(dd['titles']['title_custom'].get('#text')                    or map['title_eng'], features="html.parser").get_text().strip()
-    map['synopsis_rus'] =              mySoap(dd['publications'].get('ru',{}).get('synopsis_long',''))            or map['synopsis_eng']
-    map['festivals_rus'] =             BeautifulSoup(dd['publications'].get('ru',{}).get('festivals')             or map['festivals_eng'], features="html.parser").get_text().strip()
-    map['directors_bio_rus'] =         BeautifulSoup(dd['publications'].get('ru',{}).get('directors_bio')         or map['directors_bio_eng'], features="html.parser").get_text().strip()
-    map['directors_filmography_rus'] = BeautifulSoup(dd['publications'].get('ru',{}).get('directors_filmography') or map['directors_filmography_eng'], features="html.parser").get_text().strip()
+    # mapping includes cleaning the HTML fields
+    with metered('record_map_seconds', document='film'):
+        crew = crew_index(FILM_CREW(dd))
+        writer.add('films', (film_id, xml_hash) + FILM.row(dict(dd, crew=crew)))
 
-    film_cursor.execute(SQL, map)
-    # print(film_cursor.statement)
-    mydb.commit()
+
+    # Crew
+    writer.sync('film_crew', 'film_id', film_id,
+        [(film_id, role, ordinal, name) for role, names in crew.items() for ordinal, name in enumerate(names, 1)])
 
 
     # Countries
-    map = { 'film_id': film_id }
-    SQL = 'DELETE FROM film_countries WHERE film_id = %(film_id)s;'
-    film_cursor.execute(SQL, map)
-
-    SQL = 'INSERT IGNORE INTO film_countries (film_id, country_code, ordinal) VALUES (%(film_id)s, %(ISOCountry)s, %(ordinal)s);'
-    ISOCountries = dd['film_info']['countries'].get('country',{})
-    if not isinstance(ISOCountries, list):
-        ISOCountries = [ISOCountries]
-    ordinal = 1
-    for ISOCountry in ISOCountries:
-        map['ISOCountry'] = ISOCountry.get('code')
-        map['ordinal'] = ordinal
-        film_cursor.execute(SQL, map)
-        ordinal += 1
+    ISOCountries = FILM_COUNTRIES(dd)
+    writer.sync('film_countries', 'film_id', film_id,
+        [(film_id, ISOCountry.get('code'), ordinal) for ordinal, ISOCountry in enumerate(ISOCountries, 1)])
 
 
     # Languages
-    map = { 'film_id': film_id }
-    SQL = 'DELETE FROM film_languages WHERE film_id = %(film_id)s;'
-    film_cursor.execute(SQL, map)
-
-    SQL = 'INSERT IGNORE INTO film_languages (film_id, language_code) VALUES (%(film_id)s, %(ISOLanguage)s);'
-    if 'language' in dd['film_info']['languages']:
-        ISOLanguages = dd['film_info']['languages']['language']
-    else:
-        ISOLanguages = []
-    if not isinstance(ISOLanguages, list):
-        ISOLanguages = [ISOLanguages]
-    for ISOLanguage in ISOLanguages:
-        map['ISOLanguage'] = ISOLanguage['code']
-        film_cursor.execute(SQL, map)
+    ISOLanguages = FILM_LANGUAGES(dd)
+    writer.sync('film_languages', 'film_id', film_id,
+        [(film_id, ISOLanguage['code']) for ISOLanguage in ISOLanguages])
 
 
     # Subtitle Languages
-    map = { 'film_id': film_id }
-    SQL = 'DELETE FROM film_subtitle_languages WHERE film_id = %(film_id)s;'
-    film_cursor.execute(SQL, map)
-
-    slSQL = 'INSERT IGNORE INTO film_subtitle_languages (film_id, language_code) VALUES (%(film_id)s, %(ISOLanguage)s);'
-    film_subtitle_languages = dd.get('film_info',{}).get('subtitle_languages',{}).get('subtitle_language',[])
-    if not isinstance(film_subtitle_languages, list):
-        film_subtitle_languages = [film_subtitle_languages]
-    for fsl in film_subtitle_languages:
-        if fsl.get('code'):
-            map['ISOLanguage'] = fsl.get('code')
-            film_cursor.execute(slSQL, map)
-            # print(film_cursor.statement)
-
-
-    mydb.commit()
+    film_subtitle_languages = [fsl.get('code') for fsl in FILM_SUBTITLE_LANGUAGES(dd) if fsl.get('code')]
+    writer.sync('film_subtitle_languages', 'film_id', film_id,
+        [(film_id, code) for code in film_subtitle_languages])
+    film_subtitles[str(film_id)] = film_subtitle_languages
 
 
     # filmType / film_info -> length_type
@@ -713,83 +811,30 @@ def fetch_film(film_id):
     ]
 
     # filmGenre / film_info -> types -> type
-    map = { 'film_id': film_id }
-    SQL = 'DELETE FROM film_genres WHERE film_id = %(film_id)s;'
-    film_cursor.execute(SQL, map)
-
-    SQLs = [
-        """INSERT IGNORE INTO c_genre (est)
-        VALUES (%(est)s)
-        ;""",
-        """INSERT IGNORE INTO film_genres (film_id, genre_est)
-        VALUES (%(film_id)s, %(est)s)
-        ;"""
-    ]
-    genres = dd['film_info'].get('types',{}).get('type',[])
-    if not isinstance(genres, list):
-        genres = [genres]
+    genres = FILM_GENRES(dd)
     for est in genres:
-        map['est'] = est
-        for SQL in SQLs:
-            film_cursor.execute(SQL, map)
+        codebooks['c_genre'].put(est)
+    writer.sync('film_genres', 'film_id', film_id, [(film_id, est) for est in genres])
 
 
     # filmKeyword / film_info -> texts -> directors_statement
-    map = { 'film_id': film_id }
-    SQL = 'DELETE FROM film_keywords WHERE film_id = %(film_id)s;'
-    film_cursor.execute(SQL, map)
-
-    SQLs = [
-        """INSERT IGNORE INTO c_keyword (est)
-        VALUES (%(est)s)
-        ;""",
-        """INSERT IGNORE INTO film_keywords (film_id, keyword_id)
-        SELECT %(film_id)s, id FROM c_keyword WHERE est = %(est)s
-        ;"""
-    ]
-    import pprint
-    pp = pprint.PrettyPrinter(indent=4).pprint
-    keywords = dd['film_info']['texts']['directors_statement'].get('#text','').strip(' ,').split(',')
+    keywords = FILM_KEYWORDS(dd).strip(' ,').split(',')
     keywords = [kw.strip() for kw in keywords]
-    for keyword in keywords:
-        if keyword == '':
-            continue
-        map['est'] = keyword
-        for SQL in SQLs:
-            film_cursor.execute(SQL, map)
+    keyword_ids = [codebooks['c_keyword'].id(keyword) for keyword in keywords if keyword != '']
+    writer.sync('film_keywords', 'film_id', film_id,
+        [(film_id, keyword_id) for keyword_id in keyword_ids if keyword_id is not None])
 
 
     # logline / film_info -> texts -> logline
-    map = { 'cassette_id': film_id }
-    SQL = 'DELETE FROM film_cassette WHERE cassette_id = %(cassette_id)s;'
-    film_cursor.execute(SQL, map)
-
-    SQLs = [
-        """INSERT IGNORE INTO film_cassette (cassette_id, film_id)
-        VALUES (%(cassette_id)s, %(film_id)s)
-        ;"""
-    ]
-    import pprint
-    pp = pprint.PrettyPrinter(indent=4).pprint
-    # pp(dd['film_info']['texts']['logline'].get('#text','').strip(' ,').split(','))
-    logline = dd['film_info']['texts']['logline'].get('#text','').strip(' ,').split(',')
+    logline = FILM_CASSETTE(dd).strip(' ,').split(',')
     # rint(keywords)
     logline = [kw.strip() for kw in logline]
-    for film_id in logline:
-        if film_id == '':
-            continue
-        map['film_id'] = film_id
-        # pp = pprint.PrettyPrinter(indent=4).pprint
-        # pp(map)
-        for SQL in SQLs:
-            film_cursor.execute(SQL, map)
-            # rint(film_cursor.statement)
-
-    mydb.commit()
+    writer.sync('film_cassette', 'cassette_id', film_id,
+        [(film_id, cassette_film_id) for cassette_film_id in logline if cassette_film_id != ''])
 
-
-    film_cursor.execute(select_film_SQL, {'film_id': film_id})
-    myresult = film_cursor.fetchone()
+    if standalone:
+        with timed('db'):
+            writer.flush()
 
     # rint('{title_original} is updated ({last_update_sec} sec old) in our records'.format(**myresult))
     return myresult
@@ -805,9 +850,122 @@ def truncate():
         mydb.commit()
 
 
-if interesting_film_id:
-    fetch_base()
-else:
-    for subfest in subfests:
-        print('subfest:', subfest)
-        fetch_base(subfest)
+def init_worker(films, subtitles):
+    # a forked worker must not share the parent's DB and HTTP connections
+    global mydb, mycursor, pool, fetched_films, film_subtitles, codebooks, snapshots
+    fetched_films = films
+    film_subtitles = subtitles
+    mydb = connect()
+    mycursor = mydb.cursor()
+    codebooks = load_codebooks()
+    pool = ConnectionPool(POOL_SIZE, HTTP_TIMEOUT)
+    snapshots = None
+    if METRICS and METRICS_INTERVAL:
+        # started after the fork, a thread of the parent could fork holding the registry lock
+        registry.stream(worker_metrics_path(os.getpid()), METRICS_INTERVAL)
+
+
+def worker_metrics_path(pid):
+    # METRICS of a worker process, e.g. metrics.worker-1234.prom
+    root, ext = os.path.splitext(METRICS)
+    return '{root}.worker-{pid}{ext}'.format(root=root, pid=pid, ext=ext)
+
+
+def sync_subfest(subfest):
+    """ fetch_base(subfest), returns the counters and metrics of this subfest """
+    global snapshots
+    print('subfest:', subfest)
+    films_before, duplicates_before = film_counter, duplicate_films
+    http_before = pool.stats()
+    registry.labels['subfest'] = subfest
+    try:
+        if snapshots is None:
+            # in a worker process, an archive can't be shared with the other workers
+            snapshots = SnapshotWriter(datadir, SNAPSHOT, run=RUN + '-' + str(subfest))
+            try:
+                fetch_base(subfest)
+            finally:
+                snapshots.close()
+                snapshots = None
+        else:
+            fetch_base(subfest)
+    finally:
+        del registry.labels['subfest']
+    http_after = pool.stats()
+    return {'subfest': subfest,
+            'films': film_counter - films_before,
+            'duplicates': duplicate_films - duplicates_before,
+            'opened': http_after['opened'] - http_before['opened'],
+            'reused': http_after['reused'] - http_before['reused'],
+            'metrics': registry.samples(subfest=subfest)}
+
+
+def main():
+    """ sync everything, returns the seconds per stage """
+    parallel = PROCESSES > 1 and not BULK and not interesting_film_id
+    # parallel workers stream their own metrics, the parent has none until they are done
+    streaming = registry.stream(METRICS, METRICS_INTERVAL) if METRICS and METRICS_INTERVAL and not parallel else None
+    if interesting_film_id:
+        fetch_base()
+        snapshots.close()
+        if staging:
+            with timed('load'):
+                staging.load()
+        print('- HTTP connections: {opened} opened, {reused} reused'.format(**pool.stats()))
+        return finish(streaming)
+
+    if parallel:
+        # workers connect on their own, the parent does no DB work
+        mydb.close()
+        context = multiprocessing.get_context('fork')
+        with context.Manager() as manager:
+            films = manager.dict()
+            with ProcessPoolExecutor(max_workers=PROCESSES, initializer=init_worker, initargs=(films, manager.dict()),
+                                     mp_context=context) as executor:
+                results = []
+                for result in executor.map(sync_subfest, subfests):
+                    registry.merge(result['metrics'])
+                    results.append(result)
+            unique_films = len(films)
+    else:
+        results = [sync_subfest(subfest) for subfest in subfests]
+        unique_films = len(fetched_films)
+    snapshots.close()
+    if staging:
+        with timed('load'):
+            staging.load()
+        print('- Staged rows loaded and committed')
+
+    # in subfests order, however the workers finished
+    for result in results:
+        print('- subfest {subfest} {name}: {films} films ({duplicates} fetched before), HTTP connections {opened} opened, {reused} reused'.format(
+            name=subfests[result['subfest']], **result))
+    print('- {unique} unique films, {duplicates} duplicates, HTTP connections: {opened} opened, {reused} reused'.format(
+        unique=unique_films,
+        duplicates=sum(result['duplicates'] for result in results),
+        opened=sum(result['opened'] for result in results),
+        reused=sum(result['reused'] for result in results)))
+    return finish(streaming)
+
+
+def finish(streaming):
+    # print the seconds per stage, write the metrics and return the stages
+    if streaming:
+        streaming.set()
+    stages = registry.totals('stage_seconds', 'stage')
+    print_stage_times(stages)
+    if METRICS:
+        registry.write(METRICS)
+        print('- Metrics written to ' + METRICS)
+    return stages
+
+
+def print_stage_times(stages):
+    # a task total includes the fetch, xml, snapshot, films and db time spent in it
+    print('- Seconds per stage:')
+    for stage, seconds in sorted(stages.items()):
+        print('  {stage:<20} {seconds:9.3f}'.format(stage=stage, seconds=seconds))
+
+
+if __name__ == '__main__':
+    main()
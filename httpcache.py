@@ -0,0 +1,131 @@
+import os, json
+import hashlib
+import shutil
+import threading
+import urllib.request
+
+from atomicfile import mkstemp
+
+
+def cache_key(url):
+    # file name of the body of url, without extension
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk cache of HTTP response bodies, revalidated with conditional requests.
+
+    Every body is stored under directory with its ETag and Last-Modified.
+    Once the caller has processed a body and called done(), later requests
+    for the same URL send If-None-Match/If-Modified-Since, and a 304 answer
+    is reported as None so the caller can skip parsing and DB writes.
+    Bodies that were fetched but never marked done are requested again in
+    full. The least recently used bodies are evicted once the cache grows
+    over max_bytes.
+
+    Args:
+        directory: Where to keep the bodies, e.g. 'data/http'.
+        opener: Function taking a urllib.request.Request and returning a
+            response; a 304 must be returned, not raised.
+        max_bytes: Size limit of all cached bodies.
+        refresh: Never send conditional headers, always fetch full bodies.
+    """
+    def __init__(self, directory, opener, max_bytes=512 * 1024 * 1024, refresh=False):
+        self.directory = directory
+        self.opener = opener
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.sizes = {}
+        for fn in os.listdir(directory):
+            if fn.endswith('.body'):
+                self.sizes[fn[:-5]] = os.path.getsize(os.path.join(directory, fn))
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def _meta(self, key):
+        try:
+            with open(self._path(key, '.json')) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_meta(self, key, meta):
+        fd, tmp_fn = mkstemp(self.directory)
+        with os.fdopen(fd, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_fn, self._path(key, '.json'))
+
+    def open(self, url):
+        """
+        Return the body of url as a binary file, or None if it has not
+        changed since it was last marked done.
+        """
+        key = cache_key(url)
+        meta = self._meta(key)
+        headers = {}
+        if meta.get('done') and not self.refresh and key in self.sizes:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with self.opener(urllib.request.Request(url, headers=headers)) as response:
+            if response.status == 304 and headers:
+                os.utime(self._path(key, '.body'))
+                return None
+            fd, tmp_fn = mkstemp(self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as body_file:
+                    shutil.copyfileobj(response, body_file)
+            except BaseException:
+                os.remove(tmp_fn)
+                raise
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        os.replace(tmp_fn, self._path(key, '.body'))
+        self._write_meta(key, {'url': url, 'etag': etag, 'last_modified': last_modified, 'done': False})
+        with self.lock:
+            self.sizes[key] = os.path.getsize(self._path(key, '.body'))
+            self._evict(keep=key)
+        return open(self._path(key, '.body'), 'rb')
+
+    def cached(self, url):
+        """ The stored body of url as a binary file, e.g. after open() reported it not modified; None if there is none """
+        try:
+            return open(self._path(cache_key(url), '.body'), 'rb')
+        except OSError:
+            return None
+
+    def done(self, url):
+        """ The body of url has been processed; revalidate it from now on """
+        key = cache_key(url)
+        meta = self._meta(key)
+        if meta:
+            meta['done'] = True
+            self._write_meta(key, meta)
+
+    def _evict(self, keep):
+        total = sum(self.sizes.values())
+        if total <= self.max_bytes:
+            return
+        def last_used(key):
+            try:
+                return os.path.getmtime(self._path(key, '.body'))
+            except OSError:
+                return 0
+        for key in sorted(self.sizes, key=last_used):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.sizes.pop(key)
+            for ext in ('.body', '.json'):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
@@ -0,0 +1,134 @@
+import io
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of keep-alive HTTP(S) connections.
+
+    urlopen() takes a URL or urllib.request.Request and behaves like
+    urllib.request.urlopen for GET requests: redirects are followed and
+    statuses >= 400 raise urllib.error.HTTPError. A 304 is returned as a
+    normal response. Once a response is read to the end and closed, its
+    connection goes back to the pool and the next request to the same host
+    reuses it instead of doing a new TCP and TLS handshake.
+
+    Args:
+        size: Idle connections kept per host. More connections are opened
+            when needed, the surplus is closed after use.
+        timeout: Socket timeout of every request in seconds.
+    """
+    def __init__(self, size=8, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def stats(self):
+        with self.lock:
+            return {'opened': self.opened, 'reused': self.reused}
+
+    def _get(self, key, fresh=False):
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle and not fresh:
+                self.reused += 1
+                return idle.pop(), True
+            self.opened += 1
+        scheme, netloc = key
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(netloc, timeout=self.timeout), False
+
+    def _put(self, key, connection):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _request(self, url, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        connection, reused = self._get(key)
+        while True:
+            try:
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+                else:
+                    connection.timeout = timeout
+                connection.request('GET', path, headers=headers)
+                return PooledResponse(self, key, connection, connection.getresponse())
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                # the server has closed the idle connection, open a new one
+                connection, reused = self._get(key, fresh=True)
+
+    def urlopen(self, url, timeout=None):
+        headers = {'User-Agent': 'poff-scripts', 'Accept-Encoding': 'identity'}
+        if isinstance(url, urllib.request.Request):
+            headers.update(url.header_items())
+            url = url.full_url
+        timeout = timeout or self.timeout
+        for redirect in range(10):
+            response = self._request(url, headers, timeout)
+            location = response.headers.get('Location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                break
+            response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, location)
+        if response.status >= 400:
+            body = response.read()
+            response.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return response
+
+
+class PooledResponse:
+    """ http.client.HTTPResponse that hands its connection back to the pool on close() """
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def getcode(self):
+        return self.status
+
+    def read(self, *args):
+        return self.response.read(*args)
+
+    def readinto(self, b):
+        return self.response.readinto(b)
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if self.response.length == 0:
+            self.response.read() # e.g. 304, nothing left to read
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool._put(self.key, connection)
+        else:
+            # not read to the end or no keep-alive, the connection can't be reused
+            self.response.close()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,73 @@
+import types
+
+
+# what a missing element on the way to a value reads as
+EMPTY = types.MappingProxyType({})
+
+
+class Mapping:
+    """
+    Columns of a table and where to find them in a parsed record, compiled
+    once into one accessor function per column.
+
+    A field is (column, path), (column, path, transform) or
+    (column, path, transform, default). path is a dotted path into the
+    record, e.g. 'publications.en.cast', or a tuple of paths tried in order,
+    e.g. for a language fallback. An element with attributes, e.g.
+    {'@id': '1', '#text': 'Drama'}, reads as its text. The first non-empty
+    value found goes through transform (e.g. get_text); a field without a
+    value gets default.
+
+    Args:
+        fields: The fields, in column order.
+        default: Default of the fields that don't set their own.
+
+    Example:
+        venues = Mapping([
+            ('id', 'id'),
+            ('city', 'company_contact.address.city'),
+            ('name', ('name_en', 'name'), str.strip, ''),
+        ])
+        for item in dict_data:
+            writer.add('venues', venues.row(item))
+    """
+    def __init__(self, fields, default=None):
+        self.columns = tuple(field[0] for field in fields)
+        self.accessors = tuple(accessor(*field[1:3], default=field[3] if len(field) > 3 else default)
+                               for field in fields)
+
+    def row(self, record):
+        """ tuple of the column values of record """
+        return tuple([access(record) for access in self.accessors])
+
+    def map(self, record):
+        """ {column: value} of record, for named SQL parameters """
+        return dict(zip(self.columns, self.row(record)))
+
+
+def accessor(path, transform=None, default=None):
+    """ function(record) -> transformed value at path, or default; see Mapping """
+    getters = [_getter(path)] if isinstance(path, str) else [_getter(p) for p in path]
+    def get(record):
+        for getter in getters:
+            value = getter(record)
+            if isinstance(value, dict) and all(key[:1] in ('@', '#') for key in value):
+                value = value.get('#text')
+            if value:
+                return value
+    if transform is None:
+        def access(record):
+            return get(record) or default
+    else:
+        def access(record):
+            value = get(record)
+            return transform(value) if value else default
+    return access
+
+
+def _getter(path):
+    # 'a.b.c' -> lambda record: record.get('a', EMPTY).get('b', EMPTY).get('c')
+    keys = path.split('.')
+    source = 'lambda record: record' + ''.join('.get({key!r}, EMPTY)'.format(key=key) for key in keys[:-1]) \
+        + '.get({key!r})'.format(key=keys[-1])
+    return eval(source, {'EMPTY': EMPTY})
@@ -0,0 +1,258 @@
+import os, json
+import re
+import time
+import threading
+import itertools
+import contextlib
+import collections
+from functools import wraps
+
+from atomicfile import mkstemp
+
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds
+
+
+class Registry:
+    """
+    Counters and histograms of a run, with labels, thread-safe.
+
+    Every sample also gets the labels in self.labels, e.g. the subfest being
+    synced, so the same counter is kept per subfest and summed up for the run
+    on export. Histograms count observations in BUCKETS, like Prometheus
+    histograms.
+
+    Example:
+        registry = Registry()
+        registry.inc('http_bytes_total', len(data))
+        with registry.timer('xml_parse_seconds', document='film'):
+            dd = xmltodict.parse(data)
+        registry.write('metrics.prom')
+    """
+    def __init__(self, prefix='eventival_'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.labels = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        if self.labels:
+            labels = dict(self.labels, **labels)
+        return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+            histogram['buckets'][_bucket(value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ observe the seconds the block takes """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        """ decorator observing the seconds every call takes """
+        def decorator(f):
+            @wraps(f)
+            def timed_f(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return f(*args, **kwargs)
+            return timed_f
+        return decorator
+
+    def samples(self, **match):
+        """ copy of the samples with all labels in match, for merge() """
+        match = {label: str(value) for label, value in match.items()}
+        def matches(key):
+            labels = dict(key[1])
+            return all(labels.get(label) == value for label, value in match.items())
+        with self.lock:
+            return {'counters': [[name, labels, value] for (name, labels), value in self.counters.items() if matches((name, labels))],
+                    'histograms': [[name, labels, dict(histogram, buckets=list(histogram['buckets']))]
+                                   for (name, labels), histogram in self.histograms.items() if matches((name, labels))]}
+
+    def merge(self, samples):
+        """ add samples of another registry, e.g. of a worker process """
+        with self.lock:
+            for name, labels, value in samples['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, other in samples['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = self.histograms.setdefault(key, {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'count': 0})
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+                histogram['sum'] += other['sum']
+                histogram['count'] += other['count']
+
+    def totals(self, name, by, **match):
+        """
+        Sums of a counter or histogram per value of label by, of the samples
+        with all labels in match, e.g. totals('stage_seconds', 'stage', subfest=10)
+        """
+        match = {label: str(value) for label, value in match.items()}
+        totals = collections.Counter()
+        with self.lock:
+            samples = list(self.counters.items()) + [(key, histogram['sum']) for key, histogram in self.histograms.items()]
+        for (sample_name, labels), value in samples:
+            labels = dict(labels)
+            if sample_name == name and all(labels.get(label) == wanted for label, wanted in match.items()):
+                totals[labels.get(by)] += value
+        return totals
+
+    def to_json(self):
+        with self.lock:
+            metrics = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                metrics.setdefault(self.prefix + name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metrics.setdefault(self.prefix + name, []).append({'labels': dict(labels), 'count': histogram['count'], 'sum': histogram['sum'],
+                    'buckets': dict(zip([str(le) for le in BUCKETS] + ['+Inf'], itertools.accumulate(histogram['buckets'])))})
+        return json.dumps({'time': time.time(), 'metrics': metrics}, indent=1)
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {name} counter'.format(name=self.prefix + name))
+                lines.append('{name}{labels} {value}'.format(name=self.prefix + name, labels=_labels(labels), value=value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {name} histogram'.format(name=self.prefix + name))
+                for le, count in zip([str(le) for le in BUCKETS] + ['+Inf'], itertools.accumulate(histogram['buckets'])):
+                    lines.append('{name}_bucket{labels} {count}'.format(name=self.prefix + name, labels=_labels(labels + (('le', le),)), count=count))
+                lines.append('{name}_sum{labels} {sum}'.format(name=self.prefix + name, labels=_labels(labels), sum=histogram['sum']))
+                lines.append('{name}_count{labels} {count}'.format(name=self.prefix + name, labels=_labels(labels), count=histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ write all samples to path, as Prometheus text if it ends with .prom, else as JSON """
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_fn = mkstemp(directory)
+        with os.fdopen(fd, 'w') as metrics_file:
+            metrics_file.write(text)
+        os.replace(tmp_fn, path)
+
+    def stream(self, path, interval):
+        """ rewrite path every interval seconds until the returned event is set """
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                self.write(path)
+        threading.Thread(target=run, daemon=True).start()
+        return stop
+
+
+def _bucket(value):
+    for i, le in enumerate(BUCKETS):
+        if value <= le:
+            return i
+    return len(BUCKETS)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{label}="{value}"'.format(label=label, value=str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for label, value in labels) + '}'
+
+
+find_table = re.compile(r'\b(?:INTO(?:\s+TABLE)?|FROM|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?`?(\w+)', re.IGNORECASE)
+
+def sql_table(SQL):
+    """ table a statement works on, the first one after INTO, FROM, UPDATE or TABLE """
+    match = find_table.search(SQL)
+    return match.group(1) if match else 'other'
+
+
+class MeteredConnection:
+    """
+    DB connection counting commits and, through its cursors, the statements
+    and their seconds per table and kind (INSERT, SELECT, ...).
+    Everything else is passed on to the connection.
+    """
+    def __init__(self, connection, registry):
+        self.connection = connection
+        self.registry = registry
+
+    def cursor(self, *args, **kwargs):
+        return MeteredCursor(self.connection.cursor(*args, **kwargs), self.registry)
+
+    def commit(self):
+        with self.registry.timer('sql_commit_seconds'):
+            self.connection.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class MeteredCursor:
+    def __init__(self, cursor, registry):
+        self.cursor = cursor
+        self.registry = registry
+
+    def execute(self, SQL, *args, **kwargs):
+        with self.registry.timer('sql_seconds', table=sql_table(SQL), statement=SQL.split(None, 1)[0].upper()):
+            return self.cursor.execute(SQL, *args, **kwargs)
+
+    def executemany(self, SQL, seq_params, *args, **kwargs):
+        seq_params = list(seq_params)
+        self.registry.inc('sql_rows_total', len(seq_params), table=sql_table(SQL))
+        with self.registry.timer('sql_seconds', table=sql_table(SQL), statement=SQL.split(None, 1)[0].upper()):
+            return self.cursor.executemany(SQL, seq_params, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class CountingReader:
+    """ binary file wrapper adding the bytes read to a counter """
+    def __init__(self, binary_file, registry, name, **labels):
+        self.binary_file = binary_file
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def read(self, *args):
+        data = self.binary_file.read(*args)
+        self.registry.inc(self.name, len(data), **self.labels)
+        return data
+
+    def readinto(self, b):
+        size = self.binary_file.readinto(b)
+        self.registry.inc(self.name, size or 0, **self.labels)
+        return size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.binary_file.close()
+
+    def __getattr__(self, name):
+        return getattr(self.binary_file, name)
+
+
+registry = Registry()
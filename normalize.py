@@ -0,0 +1,42 @@
+import xmltodict
+
+
+# elements that can occur more than once, always parsed as lists:
+# name -> the parent names it repeats under, None for any parent
+REPEATED = {
+    'language': None,
+    'subtitle_language': None,
+    'country': None,
+    'person': None,
+    'relation': None,
+    'category': None,
+    'section': None,
+    'contact': None,
+    'type': ('types',), # a crew contact has a single <type> as well
+}
+
+
+def parse(xml_input, drop=(), **kwargs):
+    """
+    xmltodict.parse() that normalizes the tree while it is being built.
+
+    In the same pass it
+    - drops empty values, elements and attributes,
+    - drops the keys in drop, e.g. ('hash',) or ('@label',),
+    - makes every element in REPEATED a list, even if it occurs once,
+    so that the parsers don't need to check for missing or single values.
+    Returns {} when nothing is left. Other kwargs go to xmltodict.parse(),
+    e.g. item_depth and item_callback for streaming.
+    """
+    def postprocessor(path, key, value):
+        if not value or key in drop:
+            return None
+        return key, value
+    return xmltodict.parse(xml_input, postprocessor=postprocessor, force_list=force_list, **kwargs) or {}
+
+
+def force_list(path, key, value):
+    if key not in REPEATED:
+        return False
+    parents = REPEATED[key]
+    return parents is None or bool(path) and path[-1][0] in parents
@@ -0,0 +1,39 @@
+import os
+import urllib.parse
+
+from httpcache import cache_key
+
+
+class Replay:
+    """
+    Serves recorded response bodies from directory instead of the network.
+
+    A body is looked up the way httpcache.ResponseCache stores it, as
+    {cache_key(url)}.body, and then by the URL path below base, e.g.
+    films/521116.xml. So both the HTTP cache directory of an earlier run
+    (data/http) and a directory of hand picked XML files can be replayed.
+
+    Args:
+        directory: Where the recorded bodies are.
+        base: URL the paths of hand picked files are relative to.
+    """
+    def __init__(self, directory, base=''):
+        if not os.path.isdir(directory):
+            raise ValueError('No recorded responses in {directory}'.format(directory=directory))
+        self.directory = directory
+        self.base = base.rstrip('/') + '/'
+
+    def path(self, url):
+        recorded = os.path.join(self.directory, cache_key(url) + '.body')
+        if os.path.exists(recorded):
+            return recorded
+        if url.startswith(self.base):
+            relative = urllib.parse.urlsplit(url[len(self.base):]).path
+            recorded = os.path.join(self.directory, *relative.split('/'))
+            if os.path.exists(recorded):
+                return recorded
+        raise FileNotFoundError('No recorded response for {url} in {directory}'.format(url=url, directory=self.directory))
+
+    def open(self, url):
+        """ the recorded body of url as a binary file """
+        return open(self.path(url), 'rb')
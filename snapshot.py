@@ -0,0 +1,189 @@
+import io
+import os, json
+import gzip
+import threading
+import time
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from atomicfile import mkstemp
+
+
+FORMATS = {
+    'indent':  '.json',       # one JSON document, indented like the old dumps
+    'json':    '.json',       # one compact JSON document
+    'gzip':    '.jsonl.gz',   # JSON lines, gzip compressed
+    'zstd':    '.jsonl.zst',  # JSON lines, zstd compressed, needs the zstandard package
+    'archive': '.zip',        # one zip of JSON lines members per run
+    'none':    None,          # no snapshots
+}
+
+
+class SnapshotWriter:
+    """
+    Writes the fetched payloads to directory in one of FORMATS.
+
+    A payload is a list of records (a feed) or a single record (a film).
+    JSON lines formats store one record per line, so read_snapshot() can go
+    through them without loading the whole file. Every file is written to a
+    temporary file first and renamed when complete, a reader never sees a
+    half written snapshot. In the 'archive' format all payloads of the run go
+    to one zip, renamed into place by close().
+
+    Args:
+        directory: Where to write, e.g. 'data'.
+        format: One of FORMATS.
+        run: Name of the archive, defaults to the start time and pid.
+
+    Example:
+        snapshots = SnapshotWriter('data', 'gzip')
+        snapshots.write('films/521116', film)
+        for item in snapshots.dump_items('10_screenings', items):
+            ...
+        snapshots.close()
+    """
+    def __init__(self, directory, format='json', run=None):
+        if format not in FORMATS:
+            raise ValueError('Unknown snapshot format {format}, expected one of {formats}'.format(
+                format=format, formats=', '.join(FORMATS)))
+        if format == 'zstd' and zstandard is None:
+            raise ValueError('zstd snapshots need the zstandard package')
+        self.directory = directory
+        self.format = format
+        self.lock = threading.Lock()
+        self.archive = None
+        if format == 'archive':
+            run = run or time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid())
+            self.archive_path = os.path.join(directory, 'snapshots', run + '.zip')
+            os.makedirs(os.path.dirname(self.archive_path), exist_ok=True)
+            fd, self.archive_tmp = mkstemp(os.path.dirname(self.archive_path))
+            self.archive = zipfile.ZipFile(os.fdopen(fd, 'wb'), 'w', zipfile.ZIP_DEFLATED)
+
+    def path(self, name):
+        """ where the snapshot of name ends up """
+        if self.format == 'archive':
+            return self.archive_path + ':' + name + '.jsonl'
+        if self.format == 'none':
+            return '(no snapshot)'
+        return os.path.join(self.directory, name + FORMATS[self.format])
+
+    def write(self, name, data):
+        """ write data, a list of records or one record, as the snapshot of name """
+        for record in self.dump_items(name, data if isinstance(data, list) else [data], single=not isinstance(data, list)):
+            pass
+
+    def dump_items(self, name, items, single=False):
+        """ pass items through, writing them as the snapshot of name once all are read """
+        if self.format == 'none':
+            yield from items
+            return
+        if self.format == 'archive':
+            target = None
+            fd, tmp_fn = mkstemp(os.path.dirname(self.archive_path))
+        else:
+            target = self.path(name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            fd, tmp_fn = mkstemp(os.path.dirname(target))
+        try:
+            raw_file = os.fdopen(fd, 'wb')
+            with raw_file, self._open(raw_file) as out:
+                if self.format in ('json', 'indent'):
+                    yield from _dump_document(items, out, single, 4 if self.format == 'indent' else None)
+                else:
+                    for item in items:
+                        out.write(json.dumps(item, ensure_ascii=False, separators=(',', ':')))
+                        out.write('\n')
+                        yield item
+            if target:
+                os.replace(tmp_fn, target)
+            else:
+                with self.lock:
+                    self.archive.write(tmp_fn, name + '.jsonl')
+                os.remove(tmp_fn)
+        except BaseException:
+            # not read to the end, keep the previous snapshot
+            os.remove(tmp_fn)
+            raise
+
+    def _open(self, binary_file):
+        if self.format == 'gzip':
+            binary_file = gzip.GzipFile(fileobj=binary_file, mode='wb', compresslevel=6)
+        elif self.format == 'zstd':
+            binary_file = zstandard.ZstdCompressor().stream_writer(binary_file, closefd=True)
+        return io.TextIOWrapper(binary_file, encoding='utf-8')
+
+    def close(self):
+        if self.archive is None:
+            return
+        with self.lock:
+            archive, self.archive = self.archive, None
+            archive_file = archive.fp
+            empty = not archive.namelist()
+            archive.close()
+            archive_file.close()
+        if empty:
+            os.remove(self.archive_tmp)
+        else:
+            os.replace(self.archive_tmp, self.archive_path)
+
+
+def _dump_document(items, out, single, indent):
+    # indented like the old dumps, or as compact as it gets
+    options = {'indent': indent} if indent else {'ensure_ascii': False, 'separators': (',', ':')}
+    if single:
+        for item in items:
+            json.dump(item, out, **options)
+            yield item
+        return
+    out.write('[\n' if indent else '[')
+    for i, item in enumerate(items):
+        if i:
+            out.write(',\n' if indent else ',')
+        json.dump(item, out, **options)
+        yield item
+    out.write('\n]\n' if indent else ']')
+
+
+def read_snapshot(path, name=None):
+    """
+    Yield the records of a snapshot written by SnapshotWriter.
+
+    JSON lines snapshots are read one line at a time. For an archive, name
+    picks the member, e.g. read_snapshot('data/snapshots/run.zip', 'films/521116').
+    """
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            with archive.open(name + '.jsonl') as member:
+                yield from _read_lines(io.TextIOWrapper(member, encoding='utf-8'))
+        return
+    if path.endswith('.json'):
+        with open(path, encoding='utf-8') as json_file:
+            data = json.load(json_file)
+        yield from data if isinstance(data, list) else [data]
+        return
+    if path.endswith('.gz'):
+        text_file = gzip.open(path, 'rt', encoding='utf-8')
+    elif path.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('zstd snapshots need the zstandard package')
+        text_file = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True), encoding='utf-8')
+    else:
+        text_file = open(path, encoding='utf-8')
+    with text_file:
+        yield from _read_lines(text_file)
+
+
+def _read_lines(text_file):
+    for line in text_file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def archive_members(path):
+    """ names of the snapshots in an archive, for read_snapshot(path, name) """
+    with zipfile.ZipFile(path) as archive:
+        return [member[:-len('.jsonl')] for member in archive.namelist() if member.endswith('.jsonl')]
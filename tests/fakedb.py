@@ -0,0 +1,58 @@
+"""
+In-memory stand-in for a mysql.connector connection that records the statements.
+"""
+import weakref
+
+
+class Connection:
+    """
+    Records every statement as (SQL, params) and every commit as ('COMMIT', []).
+
+    Args:
+        results: function(SQL, params) -> rows a statement returns, no rows if not given.
+        statements: List to record into, to share one record between connections.
+    """
+    def __init__(self, results=None, statements=None):
+        self.results = results or (lambda SQL, params: [])
+        self.statements = [] if statements is None else statements
+
+    def cursor(self, *args, **kwargs):
+        return Cursor(self)
+
+    def commit(self):
+        self.statements.append(('COMMIT', []))
+
+    def close(self):
+        pass
+
+    def executed(self, prefix=''):
+        """ the recorded statements starting with prefix """
+        return [(SQL, params) for SQL, params in self.statements if SQL.startswith(prefix)]
+
+
+class Cursor:
+    def __init__(self, connection):
+        # like mysql.connector, a cursor does not keep its connection alive
+        self.connection = weakref.proxy(connection)
+        self.statement = None
+        self.rows = []
+
+    def execute(self, SQL, params=()):
+        self.statement = SQL
+        params = list(params or ())
+        self.connection.statements.append((SQL, params))
+        self.rows = list(self.connection.results(SQL, params))
+
+    def executemany(self, SQL, rows):
+        for row in rows:
+            self.execute(SQL, row)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
@@ -0,0 +1,48 @@
+"""
+Files written through atomicfile.mkstemp() get the mode open() would give them.
+"""
+import os, sys
+import stat
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from atomicfile import mkstemp
+from metrics import Registry
+from snapshot import SnapshotWriter
+
+
+class ModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.umask = os.umask(0o027)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        self.directory.cleanup()
+
+    def mode(self, path):
+        return stat.S_IMODE(os.stat(path).st_mode)
+
+    def test_mkstemp(self):
+        fd, path = mkstemp(self.directory.name)
+        os.close(fd)
+        self.assertEqual(self.mode(path), 0o640)
+        fd, other = mkstemp(self.directory.name)
+        os.close(fd)
+        self.assertNotEqual(path, other)
+
+    def test_snapshot(self):
+        snapshots = SnapshotWriter(self.directory.name, 'json')
+        snapshots.write('venues', [{'id': '1'}])
+        self.assertEqual(self.mode(snapshots.path('venues')), 0o640)
+
+    def test_metrics(self):
+        path = os.path.join(self.directory.name, 'metrics.json')
+        Registry().write(path)
+        self.assertEqual(self.mode(path), 0o640)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+"""
+BatchWriter, StagingWriter and Codebook against a fake DB that records the statements.
+"""
+import os, sys
+import gc
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fakedb
+from dbwriter import BatchWriter, StagingWriter, Codebook
+
+
+def stored(rows):
+    # results of a DB holding rows of film_keywords (film_id, keyword_id), keyed by film_id
+    def results(SQL, params):
+        if SQL.startswith('SELECT film_id, keyword_id FROM film_keywords WHERE film_id IN'):
+            return [row for row in rows if str(row[0]) in [str(param) for param in params]]
+        return []
+    return results
+
+
+class BatchWriterTest(unittest.TestCase):
+
+    def writer(self, rows=(), **kwargs):
+        self.db = fakedb.Connection(stored(rows))
+        writer = BatchWriter(self.db, **kwargs)
+        writer.table('films', ('id', 'title'), update=('title',))
+        writer.table('film_keywords', ('film_id', 'keyword_id'))
+        return writer
+
+    def test_add(self):
+        writer = self.writer()
+        writer.add('films', (1, 'Mees'))
+        writer.add('films', (2, 'Naine'))
+        writer.flush()
+        self.assertEqual(self.db.statements, [
+            ('INSERT IGNORE INTO films (id, title) VALUES (%s, %s), (%s, %s) ON DUPLICATE KEY UPDATE title=VALUES(title);',
+             [1, 'Mees', 2, 'Naine']),
+            ('COMMIT', [])])
+
+    def test_sync(self):
+        # the DB returns ints where the feed has strings
+        writer = self.writer([(1, 10), (1, 11), (2, 20)])
+        writer.sync('film_keywords', 'film_id', '1', [('1', '10'), ('1', '12')])
+        writer.sync('film_keywords', 'film_id', '2', [('2', '20')])
+        writer.sync('film_keywords', 'film_id', '3', [('3', '30')])
+        writer.flush()
+        self.assertEqual(self.db.executed('DELETE'), [
+            ('DELETE FROM film_keywords WHERE (film_id <=> %s AND keyword_id <=> %s);', [1, 11])])
+        self.assertEqual(self.db.executed('INSERT'), [
+            ('INSERT IGNORE INTO film_keywords (film_id, keyword_id) VALUES (%s, %s), (%s, %s);', ['1', '12', '3', '30'])])
+
+    def test_sync_unchanged(self):
+        writer = self.writer([(1, 10)])
+        writer.sync('film_keywords', 'film_id', 1, [(1, 10), (1, 10)])
+        writer.flush()
+        self.assertEqual([SQL for SQL, params in self.db.statements], [
+            'SELECT film_id, keyword_id FROM film_keywords WHERE film_id IN (%s);', 'COMMIT'])
+
+    def test_sync_to_nothing(self):
+        writer = self.writer([(1, 10), (1, 11)])
+        writer.sync('film_keywords', 'film_id', 1, [])
+        writer.flush()
+        self.assertEqual(self.db.executed('DELETE'), [
+            ('DELETE FROM film_keywords WHERE (film_id <=> %s AND keyword_id <=> %s) OR (film_id <=> %s AND keyword_id <=> %s);',
+             [1, 10, 1, 11])])
+
+    def test_chunks(self):
+        writer = self.writer([(film_id, 1) for film_id in range(5)], chunk_size=2)
+        for film_id in range(5):
+            writer.sync('film_keywords', 'film_id', film_id, [(film_id, 2)])
+        writer.flush()
+        self.assertEqual([len(params) for SQL, params in self.db.executed('SELECT')], [2, 2, 1])
+        self.assertEqual([len(params) for SQL, params in self.db.executed('DELETE')], [4, 4, 2])
+        self.assertEqual([len(params) for SQL, params in self.db.executed('INSERT')], [4, 4, 2])
+
+    def test_flush_every_chunk_size_records(self):
+        writer = self.writer(chunk_size=2)
+        for film_id in range(3):
+            writer.add('films', (film_id, 'Film'))
+            writer.next_record()
+        self.assertEqual(len(self.db.executed('COMMIT')), 1)
+        writer.flush()
+        self.assertEqual(len(self.db.executed('COMMIT')), 2)
+
+    def test_statement_size(self):
+        writer = self.writer(max_bytes=1000)
+        for film_id in range(5):
+            writer.add('films', (film_id, 'x' * 400))
+        writer.flush()
+        self.assertEqual([len(params) // 2 for SQL, params in self.db.executed('INSERT')], [2, 2, 1])
+
+
+class StagingWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = fakedb.Connection()
+        self.writer = StagingWriter(self.db, self.directory.name)
+        self.writer.table('films', ('id', 'title'), update=('title',), now=('updated',))
+        self.writer.table('film_keywords', ('film_id', 'keyword_id'))
+        self.writer.table('persons', ('id', 'name'), SQL='INSERT IGNORE INTO persons (id, name) VALUES (%s, %s);')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def staged(self, name):
+        self.writer.flush()
+        with open(os.path.join(self.directory.name, name + '.tsv'), encoding='utf-8', newline='') as tsv_file:
+            return tsv_file.read()
+
+    def test_escaping(self):
+        self.writer.add('films', (1, 'tab\there'))
+        self.writer.add('films', (2, 'two\nlines\r\n'))
+        self.writer.add('films', (3, 'back\\slash \\N'))
+        self.writer.add('films', (4, None))
+        self.writer.add('films', (5, 'nul\0 and Tõde'))
+        self.assertEqual(self.staged('films'),
+            '1\ttab\\there\n'
+            '2\ttwo\\nlines\\r\\n\n'
+            '3\tback\\\\slash \\\\N\n'
+            '4\t\\N\n'
+            '5\tnul\\0 and Tõde\n')
+
+    def test_sync_replaces_the_rows(self):
+        self.writer.sync('film_keywords', 'film_id', 1, [(1, 10), (1, 11)])
+        self.assertEqual(self.staged('film_keywords'), '1\t10\n1\t11\n')
+
+    def test_load(self):
+        self.writer.add('films', (1, 'Mees'))
+        self.writer.sync('film_keywords', 'film_id', 1, [(1, 10)])
+        self.writer.sync('film_keywords', 'film_id', 1, [(1, 10)])
+        self.writer.add('persons', (7, 'Tanel Toom'))
+        self.writer.load()
+        films_tsv = os.path.abspath(os.path.join(self.directory.name, 'films.tsv'))
+        keywords_tsv = os.path.abspath(os.path.join(self.directory.name, 'film_keywords.tsv'))
+        statements = [(' '.join(SQL.split()), params) for SQL, params in self.db.statements]
+        self.assertEqual(statements, [
+            ('DROP TEMPORARY TABLE IF EXISTS staging_films;', []),
+            ('CREATE TEMPORARY TABLE staging_films LIKE films;', []),
+            ("LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE staging_films CHARACTER SET utf8mb4 "
+             "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' (id, title);", [films_tsv]),
+            ('DROP TEMPORARY TABLE IF EXISTS staging_film_keywords;', []),
+            ('CREATE TEMPORARY TABLE staging_film_keywords LIKE film_keywords;', []),
+            ("LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE staging_film_keywords CHARACTER SET utf8mb4 "
+             "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' (film_id, keyword_id);", [keywords_tsv]),
+            ('DELETE FROM film_keywords WHERE film_id IN (%s);', [1]),
+            ('INSERT IGNORE INTO films (id, title, updated) SELECT id, title, now() FROM staging_films '
+             'ON DUPLICATE KEY UPDATE title=VALUES(title), updated=now();', []),
+            ('INSERT IGNORE INTO film_keywords (film_id, keyword_id) SELECT film_id, keyword_id FROM staging_film_keywords;', []),
+            ('INSERT IGNORE INTO persons (id, name) VALUES (%s, %s);', [7, 'Tanel Toom']),
+            ('COMMIT', []),
+            ('DROP TEMPORARY TABLE IF EXISTS staging_films;', []),
+            ('DROP TEMPORARY TABLE IF EXISTS staging_film_keywords;', []),
+        ])
+        self.assertEqual(self.staged('films'), '')
+
+
+class CodebookTest(unittest.TestCase):
+
+    def test_keeps_its_connection(self):
+        db = fakedb.Connection(lambda SQL, params: [(params[0], 7)] if params else [])
+        statements = db.statements
+        keywords = Codebook(db, 'c_keyword', 'est', 'id')
+        del db
+        gc.collect()
+        self.assertEqual(keywords.id('Drama'), 7)
+        self.assertEqual(statements[-1], ('SELECT est, id FROM c_keyword WHERE est = %s;', ['Drama']))
+
+    def test_case_insensitive(self):
+        db = fakedb.Connection(lambda SQL, params: [] if params else [('Director', 1), ('Producer', 2)])
+        relations = Codebook(db, 'relations', 'name', 'id')
+        self.assertIn('director', relations)
+        self.assertEqual(relations.get('PRODUCER'), 2)
+        self.assertEqual(len(db.statements), 1)
+
+    def test_miss_looked_up_once(self):
+        # the collation folds more than case, e.g. accents
+        db = fakedb.Connection(lambda SQL, params: [('Režissöör', 3)] if params == ['Rezissoor'] else [])
+        relations = Codebook(db, 'relations', 'name', 'id')
+        self.assertEqual(relations.get('Rezissoor'), 3)
+        self.assertNotIn('Actor', relations)
+        self.assertNotIn('Actor', relations)
+        self.assertEqual(relations.get('Rezissoor'), 3)
+        self.assertEqual(len(db.executed('SELECT name, id FROM relations WHERE')), 2)
+
+    def test_id_inserts_new_keys(self):
+        def results(SQL, params):
+            inserted = [params for SQL, params in db.executed('INSERT')]
+            return [(params[0], 9)] if params and params in inserted else []
+        db = fakedb.Connection(results)
+        keywords = Codebook(db, 'c_keyword', 'est', 'id')
+        self.assertEqual(keywords.id('war'), 9)
+        self.assertEqual(keywords.id('War'), 9)
+        self.assertEqual(len(db.executed('INSERT')), 1)
+
+    def test_id_of_a_key_stored_as_something_else(self):
+        db = fakedb.Connection()
+        keywords = Codebook(db, 'c_keyword', 'est', 'id')
+        self.assertIsNone(keywords.id('x' * 300))
+
+
+if __name__ == '__main__':
+    unittest.main()
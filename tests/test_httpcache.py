@@ -0,0 +1,87 @@
+"""
+ResponseCache against the local Eventival stand-in of the benchmark.
+"""
+import os, sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark import Festival, StandIn, FIRST_FILM_ID
+from httpcache import ResponseCache
+from httppool import ConnectionPool
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.festival = Festival(3)
+        cls.server = StandIn(cls.festival)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(2, 10)
+        self.venues = self.server.url + '/venues.xml'
+        self.original = self.festival.documents['/venues.xml']
+
+    def tearDown(self):
+        self.festival.documents['/venues.xml'] = self.original
+        self.directory.cleanup()
+
+    def cache(self, **kwargs):
+        return ResponseCache(self.directory.name, self.pool.urlopen, **kwargs)
+
+    def full_downloads(self, cache, url):
+        # bodies the stand-in sent in full for one open(), and what open() returned
+        before = self.server.requests
+        response = cache.open(url)
+        body = None
+        if response is not None:
+            with response:
+                body = response.read()
+        return self.server.requests - before, body
+
+    def test_not_modified_after_done(self):
+        cache = self.cache()
+        self.assertEqual(self.full_downloads(cache, self.venues), (1, self.original))
+        cache.done(self.venues)
+        self.assertEqual(self.full_downloads(cache, self.venues), (0, None))
+        with cache.cached(self.venues) as body_file:
+            self.assertEqual(body_file.read(), self.original)
+
+    def test_refetched_until_done(self):
+        cache = self.cache()
+        self.full_downloads(cache, self.venues)
+        self.assertEqual(self.full_downloads(cache, self.venues), (1, self.original))
+
+    def test_changed_body(self):
+        cache = self.cache()
+        self.full_downloads(cache, self.venues)
+        cache.done(self.venues)
+        self.festival.documents['/venues.xml'] = b'<venues></venues>'
+        self.assertEqual(self.full_downloads(cache, self.venues), (1, b'<venues></venues>'))
+
+    def test_refresh(self):
+        self.full_downloads(self.cache(), self.venues)
+        self.cache().done(self.venues)
+        self.assertEqual(self.full_downloads(self.cache(refresh=True), self.venues), (1, self.original))
+
+    def test_eviction(self):
+        film = '{url}/films/{id}.xml'.format(url=self.server.url, id=FIRST_FILM_ID)
+        cache = self.cache(max_bytes=len(self.festival.get('/films/{id}.xml'.format(id=FIRST_FILM_ID))))
+        self.full_downloads(cache, self.venues)
+        cache.done(self.venues)
+        self.full_downloads(cache, film)
+        self.assertIsNone(cache.cached(self.venues))
+        self.assertEqual(self.full_downloads(cache, self.venues)[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Replay lookups, and a whole sync of the benchmark festival replayed from disk.
+"""
+import os, sys
+import json
+import tempfile
+import subprocess
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from benchmark import Festival, FIRST_FILM_ID
+from httpcache import cache_key
+from replay import Replay
+
+BASE = 'http://eventival.invalid/ws'
+
+# runs eventivalfetch in a fresh process: a fake DB that records the statements, no network
+CHILD = '''
+import os, sys, re, json
+import mysql.connector
+
+sys.path.insert(0, os.path.join(sys.argv[1], 'tests'))
+import fakedb
+
+statements = []
+
+def results(SQL, params):
+    # every key looked up in a codebook has id 1
+    if re.match(r'SELECT \\w+(, \\w+)? FROM (c_\\w+|relations) WHERE', SQL):
+        return [(params[0], 1)]
+    return []
+
+mysql.connector.connect = lambda **kwargs: fakedb.Connection(results, statements)
+sys.path.insert(0, sys.argv[1])
+import eventivalfetch
+
+def offline(userUrl):
+    raise AssertionError('Network access in a replayed run: ' + userUrl)
+
+eventivalfetch.urlopen_with_retry = offline
+stages = eventivalfetch.main()
+with open(sys.argv[2], 'w') as result_file:
+    json.dump({'stages': stages, 'statements': [(SQL, [str(value) for value in params]) for SQL, params in statements]}, result_file)
+'''
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.replay = Replay(self.directory.name, BASE)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, relative, body):
+        path = os.path.join(self.directory.name, *relative.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as body_file:
+            body_file.write(body)
+
+    def read(self, url):
+        with self.replay.open(url) as body_file:
+            return body_file.read()
+
+    def test_by_path(self):
+        self.record('films/1.xml', b'<film/>')
+        self.assertEqual(self.read(BASE + '/films/1.xml'), b'<film/>')
+        self.assertEqual(self.read(BASE + '/films/1.xml?lang=en'), b'<film/>')
+
+    def test_cached_body_first(self):
+        self.record('films/1.xml', b'<film/>')
+        self.record(cache_key(BASE + '/films/1.xml') + '.body', b'<cached/>')
+        self.assertEqual(self.read(BASE + '/films/1.xml'), b'<cached/>')
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            self.replay.open(BASE + '/films/2.xml')
+        self.record('films/2.xml', b'<film/>')
+        with self.assertRaises(FileNotFoundError):
+            self.replay.open('http://elsewhere.invalid/ws/films/2.xml')
+
+    def test_no_directory(self):
+        with self.assertRaises(ValueError):
+            Replay(os.path.join(self.directory.name, 'missing'), BASE)
+
+
+class ReplayedSyncTest(unittest.TestCase):
+
+    def test_sync(self):
+        festival = Festival(5)
+        film_ids = [str(film_id) for film_id in range(FIRST_FILM_ID, FIRST_FILM_ID + 5)]
+        with tempfile.TemporaryDirectory() as workdir:
+            recorded = os.path.join(workdir, 'recorded')
+            paths = list(festival.documents) + ['/films/{id}.xml'.format(id=film_id) for film_id in film_ids]
+            for path in paths:
+                filename = os.path.join(recorded, *path.split('/'))
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                with open(filename, 'wb') as body_file:
+                    body_file.write(festival.get(path))
+
+            result_fn = os.path.join(workdir, 'result.json')
+            env = dict(os.environ, EVENTIVAL_URL=BASE, EVENTIVAL_REPLAY=recorded,
+                       EVENTIVAL_CACHE_MB='0', EVENTIVAL_SNAPSHOT='none')
+            subprocess.run([sys.executable, '-c', CHILD, REPO_DIR, result_fn], cwd=workdir, env=env,
+                           stdout=subprocess.DEVNULL, check=True)
+            with open(result_fn) as result_file:
+                result = json.load(result_file)
+
+        self.assertIn('task publications', result['stages'])
+        self.assertIn('task screenings', result['stages'])
+        written = set()
+        for SQL, params in result['statements']:
+            if SQL.startswith('INSERT IGNORE INTO films ('):
+                written.update(params)
+        self.assertTrue(set(film_ids) <= written, film_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
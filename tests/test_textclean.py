@@ -0,0 +1,130 @@
+"""
+textclean.get_text() and mySoap() against the BeautifulSoup code they replace.
+"""
+import os, sys
+import re
+import random
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import normalize
+import textclean
+from benchmark import Festival, FIRST_FILM_ID
+
+try:
+    from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+except ImportError:
+    BeautifulSoup = None
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def soup_text(html):
+    # what fetch_film did before textclean
+    with warnings.catch_warnings():
+        # trailer URLs and file names are fields too
+        warnings.simplefilter('ignore', MarkupResemblesLocatorWarning)
+        return BeautifulSoup(html, features="html.parser").get_text().strip()
+
+
+findquotes = re.compile(r'"([^"]*)"')
+find_brs = re.compile(r'<br[^>]*>')
+
+def soup_mySoap(text):
+    # mySoap before textclean
+    def curly(m):
+        return '“' + m.group(1) + '”'
+
+    if not text:
+        return ''
+    text = text.replace('</p>', '||BR||')
+    text = findquotes.sub(curly, text)
+    text = find_brs.sub('||BR||', text)
+    paragraphs = text.split('||BR||')
+    paragraphs = [soup_text(p) for p in paragraphs]
+    paragraphs = filter(None, paragraphs)
+    text = '\n'.join(paragraphs)
+    paragraphs = text.split('\n')
+    paragraphs = [p.strip() for p in paragraphs]
+    paragraphs = filter(None, paragraphs)
+    return "<p>" + "</p>\n<p>".join(paragraphs) + "</p>"
+
+
+def strings(tree):
+    # every text value of a parsed document
+    if isinstance(tree, dict):
+        for value in tree.values():
+            yield from strings(value)
+    elif isinstance(tree, list):
+        for value in tree:
+            yield from strings(value)
+    elif isinstance(tree, str):
+        yield tree
+
+
+FRAGMENTS = [
+    '',
+    'plain text  ',
+    '<p>Tanel Toom</p>',
+    '<p>a</p>\n\n<p>b</p>',
+    '<p>a</p>   <p>b</p>',
+    'Tom &amp; Jerry &amp;amp; co',
+    '&nbsp;&ndash;&hellip;&copy;&unknown;&amp &lt',
+    '&#8211; &#x2013; &#150; &#146; &#0; &#xD800; &#99999999;',
+    '<!-- comment -->text<!-- another -->',
+    '<![CDATA[<b>raw</b>]]> after',
+    '<!DOCTYPE html><?php echo 1; ?>text',
+    '<script>var x = "<p>";</script>visible<style>p {}</style>',
+    '<pre>  keep\n  this  </pre> and <textarea> this </textarea>',
+    '<br><br/><br />line',
+    '<p>"quoted" and "more quoted"</p>',
+    '<a href="x">link</a><img src="y"/>',
+    '<p>unclosed <b>bold',
+    '</p>stray end tags</div>',
+    '<p>\t\r\n</p>\f<p> x </p>',
+]
+
+
+@unittest.skipUnless(BeautifulSoup, 'needs bs4 to compare with')
+class ConformanceTest(unittest.TestCase):
+
+    def assertSame(self, html):
+        self.assertEqual(textclean.get_text(html), soup_text(html), repr(html))
+        self.assertEqual(textclean.mySoap(html), soup_mySoap(html), repr(html))
+
+    def test_fragments(self):
+        for html in FRAGMENTS:
+            self.assertSame(html)
+
+    def test_film_sample(self):
+        with open(os.path.join(DATA, 'film.xml'), encoding='utf-8') as film_file:
+            film = normalize.parse(film_file.read())
+        for html in strings(film):
+            self.assertSame(html)
+
+    def test_benchmark_films(self):
+        festival = Festival(20)
+        for film_id in range(FIRST_FILM_ID, FIRST_FILM_ID + 20):
+            for html in strings(normalize.parse(festival.film(film_id))):
+                self.assertSame(html)
+
+    def test_random_fragments(self):
+        rnd = random.Random(8)
+        parts = ['<p>', '</p>', '<br>', '<br/>', '<b>', '</b>', '<!-- c -->', '<script>', '</script>',
+                 '&amp;', '&nbsp;', '&#8211;', '&lt', '"', ' ', '  ', '\n', '\t', 'word', 'Tõde', 'фильм']
+        for i in range(2000):
+            self.assertSame(''.join(rnd.choice(parts) for j in range(rnd.randint(1, 20))))
+
+
+class CacheTest(unittest.TestCase):
+
+    def test_repeated_input_is_cached(self):
+        textclean.get_text.cache_clear()
+        textclean.get_text('<p>cached</p>')
+        textclean.get_text('<p>cached</p>')
+        self.assertEqual(textclean.get_text.cache_info().hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
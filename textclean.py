@@ -0,0 +1,133 @@
+import re
+import functools
+from html.parser import HTMLParser
+from html.entities import html5
+
+
+class _TextParser(HTMLParser):
+    """
+    Collects the text of an HTML fragment the way
+    BeautifulSoup(html, features="html.parser").get_text() does,
+    without building a tree: comments, declarations, processing
+    instructions and script/style contents are dropped, and a run of
+    whitespace between two tags becomes a single newline or space.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.parts = []
+        self.data = []
+        self.skip = False
+        self.preserve = 0
+
+    def end_data(self):
+        # one text node ends, like BeautifulSoup.endData
+        if not self.data:
+            return
+        data = ''.join(self.data)
+        self.data = []
+        if not self.preserve and not data.strip(' \n\t\f\r'):
+            data = '\n' if '\n' in data else ' '
+        if not self.skip:
+            self.parts.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self.end_data()
+        self.skip = tag in ('script', 'style')
+        if tag in ('pre', 'textarea'):
+            self.preserve += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.end_data()
+
+    def handle_endtag(self, tag):
+        self.end_data()
+        self.skip = False
+        if tag in ('pre', 'textarea') and self.preserve:
+            self.preserve -= 1
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_entityref(self, name):
+        character = html5.get(name + ';')
+        self.handle_data(character if character is not None else '&' + name)
+
+    def handle_charref(self, name):
+        try:
+            real_name = int(name[1:], 16) if name[:1] in 'xX' else int(name)
+        except ValueError:
+            real_name = None
+        data = None
+        if real_name is not None and 0 < real_name < 256:
+            # like BeautifulSoup, read low code points as windows-1252
+            try:
+                data = bytearray([real_name]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if not data and real_name and not 0xD800 <= real_name <= 0xDFFF:
+            try:
+                data = chr(real_name)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or '\N{REPLACEMENT CHARACTER}')
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, data):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith('CDATA['):
+            self.handle_data(data[6:])
+            self.end_data()
+
+    def close(self):
+        super().close()
+        self.end_data()
+
+
+@functools.lru_cache(maxsize=4096)
+def get_text(html):
+    """
+    Text content of an HTML fragment, stripped; the same result as
+    BeautifulSoup(html, features="html.parser").get_text().strip().
+    Results are cached, RU and ET fields often fall back to the same EN text.
+    """
+    if not html:
+        return ''
+    if '<' not in html and '&' not in html:
+        return html.strip()
+    parser = _TextParser()
+    parser.feed(html)
+    parser.close()
+    return ''.join(parser.parts).strip()
+
+
+findquotes = re.compile(r'"([^"]*)"')
+find_brs = re.compile(r'<br[^>]*>')
+
+@functools.lru_cache(maxsize=1024)
+def mySoap(text):
+    """ HTML synopsis to <p> paragraphs with curly quotes """
+
+    def curly(m):
+        return '“' + m.group(1) + '”'
+
+    if not text:
+        return ''
+    text = text.replace('</p>', '||BR||')
+    text = findquotes.sub(curly, text)
+    text = find_brs.sub('||BR||', text)
+    paragraphs = text.split('||BR||')
+    paragraphs = [get_text(p) for p in paragraphs]
+    paragraphs = filter(None, paragraphs)
+    text = '\n'.join(paragraphs)
+    paragraphs = text.split('\n')
+    paragraphs = [p.strip() for p in paragraphs]
+    paragraphs = filter(None, paragraphs)
+    return "<p>" + "</p>\n<p>".join(paragraphs) + "</p>"
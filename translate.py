@@ -1,7 +1,12 @@
 import yaml
-import os
+import os, sys
+import hashlib
+import pickle
 import collections
 
+from atomicfile import mkstemp
+from dbwriter import BatchWriter
+
 class ExtendedDict(dict):
     """changes a normal dict into one where you can hand a list
     as first argument to .get() and it will do a recursive lookup
@@ -30,56 +35,182 @@ db = {
 'passwd': os.getenv('FILMS_DB_PASSWORD'),
 'database': os.getenv('FILMS_DB_NAME')
 }
-import mysql.connector
-mydb = mysql.connector.connect(
-  host = db['host'],
-  user = db['user'],
-  passwd = db['passwd'],
-  database = db['database']
-)
-mycursor = mydb.cursor()
-
-translations = {}
-for lang in ('et','en','ru'):
-    with open(r'translate.{lang}.yaml'.format(lang=lang)) as file:
-        translations[lang] = yaml.load(file)
-
-def print_paths(p, d, l):
-    if isinstance(d, collections.abc.Mapping):
-        print('--> path: "{p}"'.format(p=p))
-        for k in d:
-            v = d[k]
-            if k in ['one', 'multiple']:
-                print('M', k, p, d[k])
-                mycursor.execute(SQL, {'path': p, 'lang': l, 'singular': d[k], 'plural': d[k]})
-                print(mycursor.statement)
-            else:
-                print_paths('{p}.{k}'.format(p=p, k=k), v, l)
-        print('<-- path: "{p}"'.format(p=p))
-    else:
-        print('    {l} = {p} = {v}'.format(l=l, p=p, v=d))
-        # mycursor.execute(SQL, {'path': p, 'lang': l, 'singular': d, 'plural': d})
-
-
 
+LANGUAGES = ('et','en','ru')
+directory = os.path.dirname(os.path.abspath(__file__))
+# libyaml's loader when PyYAML was built with it
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-SQL = """INSERT IGNORE INTO translations (path, lang, singular)
-    VALUES (%(path)s, %(lang)s, %(singular)s)
-    ON DUPLICATE KEY UPDATE
-    plural = %(plural)s
-    ;"""
 
-for lang in ('et','en','ru'):
-    for p in translations[lang]:
-        print_paths(p, translations[lang][p], lang)
-        mydb.commit()
+def connect():
+    import mysql.connector
+    return mysql.connector.connect(
+      host = db['host'],
+      user = db['user'],
+      passwd = db['passwd'],
+      database = db['database']
+    )
 
 
-
-
-translations = ExtendedDict(translations)
+def read_yaml(lang):
+    """
+    Parsed translate.{lang}.yaml, from the pickled translate.{lang}.yaml.cache
+    next to it while the file has the same mtime and size, or the same
+    SHA-256 after a touch or checkout.
+    """
+    path = os.path.join(directory, 'translate.{lang}.yaml'.format(lang=lang))
+    cache_path = path + '.cache'
+    stat = os.stat(path)
+    cached = None
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        if (cached['mtime'], cached['size']) == (stat.st_mtime_ns, stat.st_size):
+            return cached['tree']
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+        cached = None
+    with open(path, 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if cached and cached['sha256'] == digest:
+        tree = cached['tree']
+    else:
+        tree = yaml.load(data, Loader=Loader) or {}
+    try:
+        fd, tmp_fn = mkstemp(directory)
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump({'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': digest, 'tree': tree}, cache_file)
+        os.replace(tmp_fn, cache_path)
+    except OSError:
+        # read-only checkout, parse again next time
+        pass
+    return tree
+
+def flatten(d, lang, path=''):
+    """ yield a (path, lang, singular, plural) row for every one/multiple entry of the tree d """
+    if not isinstance(d, collections.abc.Mapping):
+        return
+    if 'one' in d or 'multiple' in d:
+        singular = d.get('one', d.get('multiple'))
+        yield (path, lang, singular, d.get('multiple', singular))
+    for k in d:
+        if k not in ['one', 'multiple']:
+            yield from flatten(d[k], lang, '{p}.{k}'.format(p=path, k=k) if path else str(k))
+
+
+def diff_translations(mydb, translations):
+    """
+    Compare the translations table with the trees, read with one query.
+    Returns {'inserted': [...], 'changed': [...], 'removed': [...]} of
+    (path, lang) keys and the wanted {(path, lang): (singular, plural)}.
+    Rows of other languages than LANGUAGES are left alone.
+    """
+    wanted = {}
+    for lang in LANGUAGES:
+        for path, lang, singular, plural in flatten(translations[lang], lang):
+            wanted[(path, lang)] = (singular, plural)
+    cursor = mydb.cursor()
+    cursor.execute('SELECT path, lang, singular, plural FROM translations;')
+    existing = {(path, lang): (singular, plural) for path, lang, singular, plural in cursor.fetchall()}
+    def text(value):
+        return None if value is None else str(value)
+    diff = {
+        'inserted': [key for key in wanted if key not in existing],
+        'changed': [key for key in wanted if key in existing and tuple(map(text, existing[key])) != tuple(map(text, wanted[key]))],
+        'removed': [key for key in existing if key not in wanted and key[1] in LANGUAGES],
+    }
+    return diff, wanted
+
+
+def import_translations(mydb, translations, dry_run=False):
+    """ write only the inserted, changed and removed translations, in one transaction; returns the diff """
+    diff, wanted = diff_translations(mydb, translations)
+    if dry_run:
+        return diff
+    writer = BatchWriter(mydb)
+    writer.table('translations', ('path', 'lang', 'singular', 'plural'), update=('singular', 'plural'))
+    for key in diff['inserted'] + diff['changed']:
+        writer.add('translations', key + wanted[key])
+    removed = diff['removed']
+    for i in range(0, len(removed), writer.chunk_size):
+        chunk = removed[i:i + writer.chunk_size]
+        SQL = 'DELETE FROM translations WHERE (path, lang) IN ({keys});'.format(keys=', '.join(['(%s, %s)'] * len(chunk)))
+        writer.cursor.execute(SQL, [value for key in chunk for value in key])
+    writer.flush()
+    return diff
+
+
+def sync(dry_run=False):
+    """ bring the translations table up to date with translate.*.yaml: python translate.py [--dry-run] """
+    diff = import_translations(connect(), {lang: load(lang) for lang in LANGUAGES}, dry_run)
+    for kind in ('inserted', 'changed', 'removed'):
+        for path, lang in diff[kind]:
+            print('{kind:8} {lang} {path}'.format(kind=kind, lang=lang, path=path))
+    print('Translations {done}: {counts}'.format(done='to sync' if dry_run else 'synced',
+        counts=', '.join('{count} {kind}'.format(count=len(diff[kind]), kind=kind) for kind in ('inserted', 'changed', 'removed'))))
+
+
+def compile_index(translations):
+    """
+    Flat lookup tables of the translation trees, built once:
+    {(lang, dotted.path): value} of every entry, branches included, and
+    {(lang, dotted.path): (singular, plural)} of the one/multiple entries.
+    Paths and strings are interned, a lookup is a single hash probe.
+    """
+    index = {}
+    plurals = {}
+    def walk(d, lang, path):
+        index[(lang, sys.intern(path))] = sys.intern(d) if isinstance(d, str) else d
+        if isinstance(d, collections.abc.Mapping):
+            for k in d:
+                walk(d[k], lang, '{p}.{k}'.format(p=path, k=k))
+    for lang in translations:
+        for k in translations[lang]:
+            walk(translations[lang][k], sys.intern(lang), str(k))
+        for path, lang, singular, plural in flatten(translations[lang], lang):
+            plurals[(sys.intern(lang), sys.intern(path))] = (singular, plural)
+    return index, plurals
+
+
+# loaded on first use of a language
+translations = ExtendedDict()
+index = {}
+plurals = {}
+
+def load(lang):
+    """ translation tree of lang, read and added to the index on first use """
+    if lang not in translations:
+        tree = read_yaml(lang)
+        lang_index, lang_plurals = compile_index({lang: tree})
+        index.update(lang_index)
+        plurals.update(lang_plurals)
+        translations[lang] = tree
+    return translations[lang]
 
 def strings(key, lang):
-    path = '{lang}.{key}'.format(lang=lang, key=key).split('.')
-    default = '[{key}]'.format(key=key)
-    return translations.multi_level_get(path, default)
+    """ translation of the dotted key, '[key]' if there is none """
+    value = index.get((lang, key))
+    if value is None:
+        if lang in LANGUAGES and lang not in translations:
+            load(lang)
+            return strings(key, lang)
+        return '[{key}]'.format(key=key)
+    return value
+
+def plural(key, lang, count):
+    """ singular or plural form of key for count things """
+    forms = plurals.get((lang, key))
+    if forms is None:
+        if lang in LANGUAGES and lang not in translations:
+            load(lang)
+            return plural(key, lang, count)
+        return '[{key}]'.format(key=key)
+    return forms[0] if count == 1 else forms[1]
+
+def strings_many(keys, lang):
+    """ [strings(key, lang) for key in keys], for rendering a page in one call """
+    return [strings(key, lang) for key in keys]
+
+
+if __name__ == '__main__':
+    sync(dry_run='--dry-run' in sys.argv[1:])